@@ -0,0 +1,123 @@
+"""
+module for feeding patient pathways to the LSTM pathway model in batches
+Version 1.1.0
+for use with simulacrum_release_v1.1.0
+"""
+
+import numpy as np
+import sequences
+
+padding_options = ['post', 'pre']
+
+
+class BucketedBatches(object):
+
+    """
+    Padded batches of the sequences of a SequenceStore, for training the
+    LSTM pathway autoencoder (docs/LSTM.png) on the CPU.
+
+    The sequences are sorted by length and cut into batches of batch_size,
+    so a batch is only padded up to the longest sequence in it rather than
+    the longest in the cohort. Batch i is made when it is asked for, from the
+    (possibly memory-mapped) store arrays, so memory use is one batch.
+
+    Each batch is ((tokens, day_gaps), tokens):
+    - tokens: batch_size x length int32 array of vocabulary positions + 1,
+      with 0 for padding (for mask_zero=True embeddings)
+    - day_gaps: days since the previous event of the sequence, 0 for the
+      first event and the padding
+
+    Use __iter__ for one epoch, forever() as a generator for fit_generator,
+    or pass it as a keras Sequence (__len__, __getitem__, on_epoch_end).
+    """
+
+    def __init__(self, store, batch_size=64, max_length=None, padding='post', shuffle=True, seed=1):
+        """
+        store: SequenceStore, or output of slap.Sequenceofevents
+        max_length: sequences longer than this keep their last max_length events
+        padding: 'post' pads after the events, 'pre' before them
+        shuffle: shuffle the order of the batches (and of the sequences of the
+                 same length) every epoch
+        """
+        if padding not in padding_options:
+            raise ValueError("padding must be one of " + str(padding_options))
+        if not isinstance(store, sequences.SequenceStore):
+            store = sequences.SequenceStore.from_events(store)
+        self.store = store
+        self.batch_size = batch_size
+        self.padding = padding
+        self.shuffle = shuffle
+        self.rng = np.random.RandomState(seed)
+        self.ends = np.asarray(store.offsets[1:], dtype=np.int64)
+        self.lengths = store.lengths()
+        if max_length is not None:
+            self.lengths = np.minimum(self.lengths, max_length)
+        self.on_epoch_end()
+
+    def __len__(self):
+        return len(self.batch_starts)
+
+    def __getitem__(self, i):
+        start = self.batch_starts[self.batch_order[i]]
+        positions = self.order[start:start + self.batch_size]
+        lengths = self.lengths[positions]
+        length = lengths.max() if len(lengths) else 0
+        columns = np.arange(length)
+        if self.padding == 'pre':
+            columns = columns - length
+            filled = columns >= -lengths[:, None]
+            index = self.ends[positions, None] + columns
+        else:
+            filled = columns < lengths[:, None]
+            index = (self.ends[positions] - lengths)[:, None] + columns
+        index = np.where(filled, index, 0)
+        tokens = np.where(filled, np.asarray(self.store.tokens)[index] + 1, 0).astype(np.int32)
+        days = np.asarray(self.store.days)
+        sequence_starts = np.asarray(self.store.offsets[:-1], dtype=np.int64)[positions]
+        has_previous = filled & (index > sequence_starts[:, None])
+        day_gaps = np.where(has_previous, days[index] - days[np.maximum(index - 1, 0)], 0).astype(np.int32)
+        return (tokens, day_gaps), tokens
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+        self.on_epoch_end()
+
+    def forever(self):
+        """
+        Generator of batches that carries on epoch after epoch.
+        """
+        while True:
+            for batch in self:
+                yield batch
+
+    def on_epoch_end(self):
+        """
+        Works out the batches of the next epoch.
+        """
+        if self.shuffle:
+            # sort by length, in random order within each length
+            self.order = np.lexsort((self.rng.random_sample(len(self.lengths)), self.lengths))
+        else:
+            self.order = np.argsort(self.lengths, kind='mergesort')
+        self.batch_starts = np.arange(0, len(self.order), self.batch_size)
+        self.batch_order = np.arange(len(self.batch_starts))
+        if self.shuffle:
+            self.rng.shuffle(self.batch_order)
+
+    def padding_report(self):
+        """
+        Dict with the number of events, the number of cells in the padded
+        batches, and the fraction of the cells that are padding here and
+        if every sequence were padded to the longest one.
+        """
+        events = int(self.lengths.sum())
+        batch_lengths = np.maximum.reduceat(self.lengths[self.order], self.batch_starts) \
+            if len(self.order) else np.zeros(0, dtype=np.int64)
+        batch_sizes = np.diff(np.append(self.batch_starts, len(self.order)))
+        cells = int((batch_lengths*batch_sizes).sum())
+        global_cells = int(len(self.lengths)*(self.lengths.max() if len(self.lengths) else 0))
+        return {'events': events,
+                'padded_cells': cells,
+                'padding_fraction': 1 - events/cells if cells else 0.0,
+                'global_padding_fraction': 1 - events/global_cells if global_cells else 0.0}
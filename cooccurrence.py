@@ -0,0 +1,158 @@
+"""
+module for the co-occurrence of regimens and drugs in the SACT tables
+Version 1.1.0
+for use with simulacrum_release_v1.1.0
+"""
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+import load
+
+
+class RegimenDrugMatrix(object):
+
+    """
+    Weighted bipartite graph of MAPPED_REGIMEN and DRUG_GROUP as a sparse
+    matrix: matrix[i, j] is the number of sact_drug_detail rows of drug
+    group drugs[j] that belong (through MERGED_REGIMEN_ID) to a regimen
+    with mapped regimen regimens[i].
+
+    Build one from the tables with from_tables.
+    """
+
+    def __init__(self, matrix, regimens, drugs):
+        self.matrix = matrix.tocsr()
+        self.regimens = pd.Index(regimens, name='MAPPED_REGIMEN')
+        self.drugs = pd.Index(drugs, name='DRUG_GROUP')
+        self._normalised = None
+
+    @classmethod
+    def from_tables(cls,
+                    tables=None,
+                    chunksize=None,
+                    folder=load.default_folder,
+                    prefix=load.default_prefix):
+        """
+        Counts the drug details of each (MAPPED_REGIMEN, DRUG_GROUP) pair
+        from the categorical codes, looking up each drug detail's regimen by
+        MERGED_REGIMEN_ID (no merge of the tables, no strings built). Drug
+        details with no regimen or no drug group are left out.
+
+        tables: dict with 'sact_regimen' and/or 'sact_drug_detail' already
+                loaded; the others are loaded with just the columns needed
+        chunksize: read sact_drug_detail with load.iter_table in chunks of
+                   this many rows instead of all at once
+        """
+        tables = tables or {}
+        if 'sact_regimen' in tables:
+            regimen = tables['sact_regimen'][['MERGED_REGIMEN_ID', 'MAPPED_REGIMEN']]
+        else:
+            regimen = load.load_table('sact_regimen', columns=['MERGED_REGIMEN_ID', 'MAPPED_REGIMEN'],
+                                      folder=folder, prefix=prefix)
+        regimen_ids, first = np.unique(regimen['MERGED_REGIMEN_ID'].values, return_index=True)
+        regimen_codes, regimens = pd.factorize(regimen['MAPPED_REGIMEN'].values[first], sort=True)
+
+        columns = ['MERGED_REGIMEN_ID', 'DRUG_GROUP']
+        if 'sact_drug_detail' in tables:
+            drugs = _categories(tables['sact_drug_detail']['DRUG_GROUP'])
+            chunks = [tables['sact_drug_detail'][columns]]
+        elif chunksize is None:
+            chunks = [load.load_table('sact_drug_detail', columns=columns, folder=folder, prefix=prefix)]
+            drugs = _categories(chunks[0]['DRUG_GROUP'])
+        else:
+            drugs = load.table_categories('sact_drug_detail', ['DRUG_GROUP'], chunksize,
+                                          folder=folder, prefix=prefix)['DRUG_GROUP']
+            chunks = load.iter_table('sact_drug_detail', chunksize, columns=columns,
+                                     categories={'DRUG_GROUP': drugs}, folder=folder, prefix=prefix)
+
+        shape = (len(regimens), len(drugs))
+        matrix = scipy.sparse.csr_matrix(shape, dtype=np.int64)
+        for chunk in chunks:
+            drug_codes = pd.Categorical(chunk['DRUG_GROUP'], categories=drugs).codes.astype(np.int64)
+            row_codes = np.full(len(chunk), -1, dtype=np.int64)
+            if len(regimen_ids):
+                positions = np.searchsorted(regimen_ids, chunk['MERGED_REGIMEN_ID'].values)
+                positions[positions == len(regimen_ids)] = 0
+                found = regimen_ids[positions] == chunk['MERGED_REGIMEN_ID'].values
+                row_codes[found] = regimen_codes[positions[found]]
+            known = (row_codes >= 0) & (drug_codes >= 0)
+            # only the pairs that occur are stored, duplicates summed by tocsr
+            matrix = matrix + scipy.sparse.coo_matrix((np.ones(known.sum(), dtype=np.int64),
+                                                       (row_codes[known], drug_codes[known])),
+                                                      shape=shape).tocsr()
+        matrix.sum_duplicates()
+        return cls(matrix, np.asarray(regimens), np.asarray(drugs))
+
+    def drugs_of(self, regimen):
+        """
+        Drug groups given in a mapped regimen, with their counts, most
+        frequent first.
+        """
+        row = self.matrix.getrow(self.regimens.get_loc(regimen))
+        return _sorted_series(row.indices, row.data, self.drugs)
+
+    def regimens_of(self, drug):
+        """
+        Mapped regimens a drug group is given in, with their counts, most
+        frequent first.
+        """
+        column = self.matrix.getcol(self.drugs.get_loc(drug)).tocsc()
+        return _sorted_series(column.indices, column.data, self.regimens)
+
+    def regimen_projection(self, normalise=True):
+        """
+        regimens x regimens sparse matrix of how much their drugs overlap:
+        the cosine similarity of their drug counts (normalise=True) or
+        the sum over drugs of the product of their counts.
+        """
+        matrix = self.normalised() if normalise else self.matrix.astype(float)
+        return matrix.dot(matrix.T).tocsr()
+
+    def normalised(self):
+        """
+        The matrix with each regimen's row of drug counts scaled to unit
+        length, worked out once and kept.
+        """
+        if self._normalised is None:
+            matrix = self.matrix.astype(float)
+            lengths = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+            lengths[lengths == 0] = 1
+            self._normalised = scipy.sparse.diags(1/lengths).dot(matrix).tocsr()
+        return self._normalised
+
+    def similar_regimens(self, regimen, k=10):
+        """
+        The k mapped regimens whose drugs are most like those of regimen
+        (by cosine similarity of drug counts).
+        """
+        i = self.regimens.get_loc(regimen)
+        normalised = self.normalised()
+        # just the row of regimen, not the whole regimens x regimens product
+        row = normalised.getrow(i).dot(normalised.T).tocsr()
+        keep = row.indices != i
+        return _sorted_series(row.indices[keep], row.data[keep], self.regimens)[:k]
+
+    def to_networkx(self):
+        """
+        networkx DiGraph with an edge from "MAPPED_REGIMEN = <regimen>" to
+        "DRUG_GROUP = <drug>" for every pair that occurs, with the count as
+        its 'weight', as built in networkx.ipynb.
+        """
+        import networkx as nx
+        coo = self.matrix.tocoo()
+        graph = nx.DiGraph()
+        graph.add_weighted_edges_from(zip("MAPPED_REGIMEN = " + self.regimens[coo.row].astype(str),
+                                          "DRUG_GROUP = " + self.drugs[coo.col].astype(str),
+                                          coo.data.tolist()))
+        return graph
+
+
+def _categories(values):
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return list(values.cat.categories)
+    return sorted(values.dropna().unique())
+
+def _sorted_series(positions, counts, labels):
+    order = np.argsort(-counts, kind='mergesort')
+    return pd.Series(counts[order], index=labels[positions[order]], name='count')
@@ -5,6 +5,8 @@ for use with simulacrum_release_v1.1.0
 """
 
 import os
+import collections
+import numpy as np
 import pandas as pd
 
 default_folder="lookup_tables"
@@ -45,6 +47,59 @@ zlookup_table_names = [
 ]
 
 
+zlookup_dicts = { 
+    'av_patient': {
+        "SEX":"SEX",
+        "ETHNICITY":"ETHNICITY",
+        "DEATHLOCATIONCODE":"DEATHLOCATION",
+        "DEATHCAUSECODE_1A":"DEATHCAUSE",              
+        "DEATHCAUSECODE_1B":"DEATHCAUSE",              
+        "DEATHCAUSECODE_1C":"DEATHCAUSE",
+        "DEATHCAUSECODE_2":"DEATHCAUSE",
+        "DEATHCAUSECODE_UNDERLYING":"DEATHCAUSE",
+        "NEWVITALSTATUS":"VITALSTATUS"
+    },
+    'av_tumour':  {
+        "SITE_ICD10_O2":"ICDFULL",
+        "SITE_ICD10_O2_3CHAR":"ICD3CHAR",
+        "MORPH_ICD10_O2":"MORPHOLOGY",
+        "BEHAVIOUR_ICD10_O2":"BEHAVIOUR",
+        "STAGE_BEST":"STAGE",
+        "GRADE":"GRADE",
+        "SEX":"SEX",
+        "CREG_CODE":"CREG",
+        "ER_STATUS":"ERPRSTATUS",
+        "PR_STATUS":"ERPRSTATUS",
+        "HER2_STATUS":"ERPRSTATUS",
+        "CANCERCAREPLANINTENT":"CANCERCAREPLANINTENT",
+        "PERFORMANCESTATUS":"PERFORMANCE",
+        "CNS":"CNS",
+        "ACE27":"ACE27SCORE",
+        "LATERALITY":"LATERALITY"
+    },
+    'sact_patient': {
+    },
+    'sact_tumour': {
+        "CONSULTANT_SPECIALITY_CODE":"CONSULTANTSPECIALITY",
+        "PRIMARY_DIAGNOSIS":"ICDFULL",
+        "MORPHOLOGY_CLEAN":"HISTOLOGY"
+    },
+    'sact_regimen': {
+        "INTENT_OF_TREATMENT":"REGIMENINTENT",
+        "CLINICAL_TRIAL":"CLINICALTRIAL"
+    },
+    'sact_outcome': {
+        "REGIMEN_OUTCOME_SUMMARY":"REGIMENOUTCOME"
+    },
+    'sact_cycle': {
+        "PERF_STATUS_START_OF_CYCLE":"PERFORMANCE"
+    },
+    'sact_drug_detail': {
+        "ADMINISTRATION_ROUTE":"ADMINISTRATIONROUTE"
+    }
+}
+
+
 
 def add_descriptions(table,
                      table_name,
@@ -57,68 +112,19 @@ def add_descriptions(table,
     to add all available descriptions to the table.  
     
     Alternatively, to save time, set columns argument to be only the columns 
-    you want descriptions of. (In particular, the deathcausecode columns in 
-    av_patient take a long time to run)
+    you want descriptions of.
     
     If you need something more general use:
       
         table[new_name] = get_description(table[column_name], zlookup)
     
+    Descriptions of categorical columns are categorical too, with one
+    category per description rather than a string per row.
+    To only work out descriptions when they are used see DescriptionView.
+    
     Modifies the table and also returns it.
     """
     
-    zlookup_dicts = { 
-        'av_patient': {
-            "SEX":"SEX",
-            "ETHNICITY":"ETHNICITY",
-            "DEATHLOCATIONCODE":"DEATHLOCATION",
-            "DEATHCAUSECODE_1A":"DEATHCAUSE",              
-            "DEATHCAUSECODE_1B":"DEATHCAUSE",              
-            "DEATHCAUSECODE_1C":"DEATHCAUSE",
-            "DEATHCAUSECODE_2":"DEATHCAUSE",
-            "DEATHCAUSECODE_UNDERLYING":"DEATHCAUSE",
-            "NEWVITALSTATUS":"VITALSTATUS"
-        },
-        'av_tumour':  {
-            "SITE_ICD10_O2":"ICDFULL",
-            "SITE_ICD10_O2_3CHAR":"ICD3CHAR",
-            "MORPH_ICD10_O2":"MORPHOLOGY",
-            "BEHAVIOUR_ICD10_O2":"BEHAVIOUR",
-            "STAGE_BEST":"STAGE",
-            "GRADE":"GRADE",
-            "SEX":"SEX",
-            "CREG_CODE":"CREG",
-            "ER_STATUS":"ERPRSTATUS",
-            "PR_STATUS":"ERPRSTATUS",
-            "HER2_STATUS":"ERPRSTATUS",
-            "CANCERCAREPLANINTENT":"CANCERCAREPLANINTENT",
-            "PERFORMANCESTATUS":"PERFORMANCE",
-            "CNS":"CNS",
-            "ACE27":"ACE27SCORE",
-            "LATERALITY":"LATERALITY"
-        },
-        'sact_patient': {
-        },
-        'sact_tumour': {
-            "CONSULTANT_SPECIALITY_CODE":"CONSULTANTSPECIALITY",
-            "PRIMARY_DIAGNOSIS":"ICDFULL",
-            "MORPHOLOGY_CLEAN":"HISTOLOGY"
-        },
-        'sact_regimen': {
-            "INTENT_OF_TREATMENT":"REGIMENINTENT",
-            "CLINICAL_TRIAL":"CLINICALTRIAL"
-        },
-        'sact_outcome': {
-            "REGIMEN_OUTCOME_SUMMARY":"REGIMENOUTCOME"
-        },
-        'sact_cycle': {
-            "PERF_STATUS_START_OF_CYCLE":"PERFORMANCE"
-        },
-        'sact_drug_detail': {
-            "ADMINISTRATION_ROUTE":"ADMINISTRATIONROUTE"
-        }
-    }
-    
     table_name = table_name.lower()
     try:
         zlookup_dict = zlookup_dicts[table_name]
@@ -136,10 +142,20 @@ def add_descriptions(table,
     if not all ([column in table.columns for column in columns]):
         raise ValueError("the table does not contain those columns. Is table_name correct?")
    
+    # the death cause columns share their codes, so translate them together
+    deathcause_columns = [column for column in columns 
+                          if zlookup_dict[column] == "DEATHCAUSE"]
+    if len(deathcause_columns) > 0:
+        translated = get_deathcause_descriptions(table, deathcause_columns,
+                                                 folder=folder, prefix=prefix)
+    
     for column in columns:
-        table[column + "_DESC"] = get_descriptions(table[column],
-                                                   zlookup_dict[column],
-                                                   folder=folder, prefix=prefix)
+        if column in deathcause_columns:
+            table[column + "_DESC"] = translated[column]
+        else:
+            table[column + "_DESC"] = get_descriptions(table[column],
+                                                       zlookup_dict[column],
+                                                       folder=folder, prefix=prefix)
         
     if table_name == 'av_tumour' and histology:
         table["HISTOLOGY_DESC"] = get_histology_description_2(table["MORPH_ICD10_O2"],
@@ -150,6 +166,74 @@ def add_descriptions(table,
 
 
 
+class DescriptionView(object):
+    
+    """
+    The description columns of a table, each worked out the first time it
+    is asked for and then kept, e.g.
+    
+        view = DescriptionView(av_tumour, 'av_tumour')
+        view['SITE_ICD10_O2_DESC']             # computed now
+        view.add_to_table(['STAGE_BEST_DESC'])  # copies into av_tumour
+        
+    view.keys() lists the available description columns.
+    """
+    
+    def __init__(self, table, table_name, histology=True,
+                 folder=default_folder, prefix=default_prefix):
+        table_name = table_name.lower()
+        if not table_name in zlookup_dicts:
+            raise ValueError("table_name must be in " + str(zlookup_dicts.keys()))
+        self.table = table
+        self.table_name = table_name
+        self.folder = folder
+        self.prefix = prefix
+        self.columns = {column + "_DESC": column for column in zlookup_dicts[table_name]
+                        if column in table.columns}
+        if (table_name == 'av_tumour' and histology and
+            "MORPH_ICD10_O2" in table.columns and "BEHAVIOUR_ICD10_O2" in table.columns):
+            self.columns["HISTOLOGY_DESC"] = None
+        self.computed = {}
+        
+    def keys(self):
+        return list(self.columns.keys())
+    
+    def __iter__(self):
+        return iter(self.columns)
+    
+    def __len__(self):
+        return len(self.columns)
+    
+    def __contains__(self, name):
+        return name in self.columns
+    
+    def __getitem__(self, name):
+        if not name in self.columns:
+            raise KeyError(name)
+        if not name in self.computed:
+            column = self.columns[name]
+            if column is None:
+                self.computed[name] = get_histology_description_2(self.table["MORPH_ICD10_O2"],
+                                                                  self.table["BEHAVIOUR_ICD10_O2"],
+                                                                  folder=self.folder,
+                                                                  prefix=self.prefix)
+            else:
+                self.computed[name] = get_descriptions(self.table[column],
+                                                       zlookup_dicts[self.table_name][column],
+                                                       folder=self.folder,
+                                                       prefix=self.prefix)
+        return self.computed[name]
+    
+    def add_to_table(self, names=None):
+        """
+        Adds description columns (default all) to the table and returns it.
+        """
+        if names == None:
+            names = self.keys()
+        for name in names:
+            self.table[name] = self[name]
+        return self.table
+
 
 
 def get_descriptions(codes, zlookup, folder=default_folder, prefix=default_prefix):
@@ -173,9 +257,9 @@ def get_descriptions(codes, zlookup, folder=default_folder, prefix=default_prefi
         raise ValueError("this function won't work for icdclassification. did you want icd?")
     if not zlookup.lower() in zlookup_table_names:
         raise ValueError("zlookup must be in " + str(zlookup_table_names))
-          
-    zlookup_table = load_zlookup_table(zlookup, folder, prefix)
-    return pd.Series(codes).map(zlookup_table["SHORTDESC"])
+
+    mapping = get_zlookup_mapping(zlookup, folder=folder, prefix=prefix)
+    return translate(codes, mapping)
 
     
     
@@ -184,16 +268,69 @@ def get_histology_description_2(morphology, behaviour, folder=default_folder, pr
     """
     Get the histology from two lists or pandas series
     containing morphology and behaviour.
+    
+    Each distinct (morphology, behaviour) pair is looked up once in an index
+    of the lookup table, then the descriptions are spread back over the rows.
+    The result has the same rows and index as morphology. It is categorical
+    if both inputs are.
+    """
+    
+    morphology = pd.Series(morphology)
+    if isinstance(behaviour, pd.Series):
+        behaviour = behaviour.reindex(morphology.index)
+    else:
+        behaviour = pd.Series(behaviour, index=morphology.index)
+    mapping = get_histology_mapping(folder=folder, prefix=prefix)
+    
+    morphology_codes, morphology_uniques = _codes(morphology)
+    behaviour_codes, behaviour_uniques = _codes(behaviour)
+    # pack each pair of codes into one integer, -1 where either is missing
+    pair_codes = morphology_codes.astype(np.int64) * len(behaviour_uniques) + behaviour_codes
+    pair_codes[(morphology_codes < 0) | (behaviour_codes < 0)] = -1
+    unique_pairs, codes = np.unique(pair_codes, return_inverse=True)
+    present = unique_pairs >= 0
+    morphology_keys = np.asarray(morphology_uniques, dtype=object)[
+        unique_pairs[present] // len(behaviour_uniques)]
+    behaviour_keys = np.asarray(behaviour_uniques, dtype=object)[
+        unique_pairs[present] % len(behaviour_uniques)]
+    keys = pd.MultiIndex.from_arrays([morphology_keys.astype(str), behaviour_keys.astype(str)])
+    positions = np.full(len(unique_pairs), -1)
+    positions[present] = mapping.index.get_indexer(keys)
+    
+    # position -1 (not in the lookup) picks the appended NaN
+    descriptions = np.append(mapping.values.astype(object), np.nan)[positions]
+    if (isinstance(morphology.dtype, pd.CategoricalDtype) and
+        isinstance(behaviour.dtype, pd.CategoricalDtype)):
+        description_codes, categories = pd.factorize(descriptions)
+        return pd.Series(pd.Categorical.from_codes(description_codes[codes.ravel()], categories),
+                         index=morphology.index, name="DESCRIPTION")
+    return pd.Series(descriptions[codes.ravel()], index=morphology.index,
+                     name="DESCRIPTION", dtype=object)
+
+def get_histology_mapping(folder=default_folder, prefix=default_prefix):
+    
+    """
+    Series of histology descriptions indexed by (ZMORPHOLOGYID, ZBEHAVIOURID),
+    built once from zhistologylookup. Only the first description of a 
+    duplicated pair is kept.
     """
     
-    zlookup_table = load_zlookup_table('histologylookup', folder=folder, prefix=prefix)
-    df = pd.DataFrame()
-    df["ZMORPHOLOGYID"] = morphology
-    df["ZBEHAVIOURID"] = behaviour
-    merged = pd.merge(df,
-                      zlookup_table.astype(object),
-                      how='left')
-    return merged["DESCRIPTION"]
+    entry = _zlookup_cache_entry('histologylookup', folder, prefix)
+    if not "HISTOLOGY" in entry["mappings"]:
+        zlookup_table = entry["table"]
+        mapping = pd.Series(zlookup_table["DESCRIPTION"].values,
+                            index=pd.MultiIndex.from_arrays([zlookup_table["ZMORPHOLOGYID"].astype(str),
+                                                             zlookup_table["ZBEHAVIOURID"].astype(str)]))
+        entry["mappings"]["HISTOLOGY"] = mapping[~mapping.index.duplicated()]
+    return entry["mappings"]["HISTOLOGY"]
+
+def _codes(values):
+    """
+    Integer codes (-1 for missing) and the distinct values they stand for.
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return values.cat.codes.values, values.cat.categories
+    return pd.factorize(values)
 
 def get_histology_description_1(codes, folder=default_folder, prefix=default_prefix):
      
@@ -215,14 +352,40 @@ def get_deathcause_description(codes, folder=default_folder, prefix=default_pref
     
     Returns a pandas series of descriptions separated by semicolons.
     """
-    codes = pd.Series(codes).astype(str)
-    expanded = codes.str.split(',', expand=True)
-    translated = pd.DataFrame()
-    for col in expanded.columns:
-        translated[col] = get_descriptions(expanded[col], 'icdfull')
-    empty = pd.Series(index=codes.index, dtype=object)
-    contracted = empty.str.cat(translated, sep=';', na_rep='').str.strip(';')    
-    return contracted
+    codes = pd.Series(codes)
+    translated = get_deathcause_descriptions(pd.DataFrame({"CODES": codes}), ["CODES"],
+                                             folder=folder, prefix=prefix)
+    return translated["CODES"].rename(None)
+
+def get_deathcause_descriptions(table, columns, folder=default_folder, prefix=default_prefix):
+    
+    """
+    get_deathcause_description for several columns of a table at once (e.g. 
+    the five DEATHCAUSECODE columns of av_patient).
+    
+    Each distinct string of codes, across all the columns, is only split 
+    and translated once and the result is then spread over the rows.
+    
+    Returns a dataframe of descriptions with the same columns and index.
+    """
+    mapping = get_zlookup_mapping('icdfull', folder=folder, prefix=prefix)
+    lookup = mapping.dropna().to_dict()
+    memo = {}
+    translated = pd.DataFrame(index=table.index)
+    for column in columns:
+        values = table[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            codes, uniques = values.cat.codes.values, values.cat.categories
+        else:
+            codes, uniques = pd.factorize(values)
+        for unique in uniques:
+            if not unique in memo:
+                memo[unique] = ';'.join([lookup.get(code, '') 
+                                         for code in str(unique).split(',')]).strip(';')
+        # missing values have code -1, which picks the appended ''
+        descriptions = np.array([memo[unique] for unique in uniques] + [''], dtype=object)
+        translated[column] = pd.Series(descriptions[codes], index=table.index, dtype=object)
+    return translated
 
 
 
@@ -243,6 +406,80 @@ def load_zlookup_table(table_name,
 
 
 
+# zlookup tables already read, most recently used last, see get_zlookup_table
+zlookup_cache = collections.OrderedDict()
+zlookup_cache_size = 16
+
+def get_zlookup_table(table_name,
+                      folder=default_folder,
+                      prefix=default_prefix):
+    """
+    Like load_zlookup_table, but each table is only read once and then kept
+    in memory (up to zlookup_cache_size tables, dropping the least recently
+    used). A table is read again if its csv has changed since.
+
+    The table returned is shared, so copy it before modifying it.
+    """
+    entry = _zlookup_cache_entry(table_name, folder, prefix)
+    return entry["table"]
+
+def get_zlookup_mapping(table_name,
+                        column="SHORTDESC",
+                        folder=default_folder,
+                        prefix=default_prefix):
+    """
+    Series mapping the codes of a lookup table to one of its columns
+    (by default the short description). Built once per table and column.
+    """
+    entry = _zlookup_cache_entry(table_name, folder, prefix)
+    if not column in entry["mappings"]:
+        entry["mappings"][column] = entry["table"][column]
+    return entry["mappings"][column]
+
+def clear_zlookup_cache():
+    """
+    Forget all the lookup tables read so far.
+    """
+    zlookup_cache.clear()
+
+def _zlookup_cache_entry(table_name, folder, prefix):
+    read_path = os.path.join(folder, prefix + table_name.lower() + ".csv")
+    try:
+        mtime = os.stat(read_path).st_mtime_ns
+    except FileNotFoundError:
+        raise ValueError("The file " + read_path + " does not exist.")
+    entry = zlookup_cache.get(read_path)
+    if entry is None or entry["mtime"] != mtime:
+        entry = {"mtime": mtime,
+                 "table": load_zlookup_table(table_name, folder, prefix),
+                 "mappings": {}}
+        zlookup_cache[read_path] = entry
+        while len(zlookup_cache) > zlookup_cache_size:
+            zlookup_cache.popitem(last=False)
+    zlookup_cache.move_to_end(read_path)
+    return entry
+
+def translate(codes, mapping):
+    """
+    Translates a list or pandas series of codes with a mapping series
+    (code -> description), keeping the index of a series.
+
+    For categorical codes only the categories are looked up, and the result
+    is categorical with one category per distinct description. Where each
+    code has its own description the result has the same codes as the input.
+    """
+    codes = pd.Series(codes)
+    if isinstance(codes.dtype, pd.CategoricalDtype):
+        descriptions = mapping.reindex(codes.cat.categories).values
+        description_codes, categories = pd.factorize(descriptions)
+        # missing values have code -1, which picks the appended -1
+        description_codes = np.append(description_codes, -1)[codes.cat.codes.values]
+        return pd.Series(pd.Categorical.from_codes(description_codes, categories),
+                         index=codes.index, name=codes.name)
+    return codes.map(mapping)
+
+
+
 def make_zlookup_csvs_from_sql(read_folder="simulacrum_release_v1.1.0",
                                read_prefix="insert_lookups_z",
                                write_folder=default_folder,
@@ -0,0 +1,197 @@
+"""
+module for training word2vec embeddings of pathway events
+Version 1.1.0
+for use with simulacrum_release_v1.1.0
+"""
+
+import os
+import hashlib
+import pickle
+import numpy as np
+import pandas as pd
+import sequences
+
+projection_methods = ['pca', 'umap']
+
+
+class SequenceCorpus(object):
+
+    """
+    The event sequences of a SequenceStore (or of the output of
+    slap.Sequenceofevents) as a corpus for gensim: each pass over it yields
+    one list of event strings per sequence, made as it is needed, so the
+    whole corpus is never held as python lists.
+    """
+
+    def __init__(self, store):
+        if not isinstance(store, sequences.SequenceStore):
+            store = sequences.SequenceStore.from_events(store)
+        self.store = store
+
+    def __len__(self):
+        return len(self.store)
+
+    def __iter__(self):
+        vocabulary = self.store.vocabulary
+        tokens = self.store.tokens
+        offsets = self.store.offsets
+        for i in range(len(offsets) - 1):
+            yield vocabulary[tokens[offsets[i]:offsets[i+1]]].tolist()
+
+    def key(self):
+        """
+        Hash of the sequences, for naming saved models.
+        """
+        md5 = hashlib.md5("\n".join(self.store.vocabulary).encode())
+        md5.update(np.ascontiguousarray(self.store.tokens, dtype=np.int32).view(np.uint8))
+        md5.update(np.ascontiguousarray(self.store.offsets, dtype=np.int64).view(np.uint8))
+        return md5.hexdigest()[:16]
+
+
+def train_word2vec(store,
+                   folder=None,
+                   vector_size=100,
+                   window=5,
+                   min_count=1,
+                   epochs=5,
+                   workers=None,
+                   seed=1,
+                   **kwargs):
+    """
+    Trains a gensim Word2Vec model of the events in the sequences of store
+    (a SequenceStore or the output of slap.Sequenceofevents), streaming the
+    sequences from SequenceCorpus with workers threads (default: one per cpu).
+
+    If folder is given the model is saved there, named by a hash of the
+    sequences and the training parameters, and loaded from there instead of
+    trained again when the same inputs are asked for. Other kwargs go to
+    Word2Vec.
+    """
+    corpus = SequenceCorpus(store)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    parameters = dict(vector_size=vector_size, window=window, min_count=min_count,
+                      epochs=epochs, seed=seed, **kwargs)
+    model_path = None
+    if folder is not None:
+        key = _hash(corpus.key(), sorted(parameters.items()))
+        model_path = os.path.join(folder, "word2vec." + key + ".model")
+        if os.path.exists(model_path):
+            return load_word2vec(model_path)
+    model = _word2vec(corpus, workers=workers, **parameters)
+    if model_path is not None:
+        _save(model, model_path)
+    return model
+
+def update_word2vec(model, store, folder=None, epochs=None):
+    """
+    Carries on training model on the sequences of store (e.g. a new data
+    release), adding their new events to the vocabulary, instead of training
+    from scratch. Returns the updated model, which is saved to folder if given
+    (named by a hash of the old model's vectors and the new sequences).
+    """
+    corpus = SequenceCorpus(store)
+    model_path = None
+    if folder is not None:
+        key = _hash(vectors_key(model), corpus.key(), epochs)
+        model_path = os.path.join(folder, "word2vec." + key + ".model")
+        if os.path.exists(model_path):
+            return load_word2vec(model_path)
+    model.build_vocab(corpus, update=True)
+    model.train(corpus, total_examples=len(corpus), epochs=epochs or model.epochs)
+    if model_path is not None:
+        _save(model, model_path)
+    return model
+
+def load_word2vec(model_path):
+    """
+    Loads a model saved by train_word2vec or update_word2vec.
+    """
+    from gensim.models import Word2Vec
+    if not os.path.exists(model_path):
+        raise ValueError("The file " + model_path + " does not exist.")
+    return Word2Vec.load(model_path)
+
+def vectors_key(model):
+    """
+    Hash of the event vectors of a model.
+    """
+    vocabulary = _vocabulary(model)
+    md5 = hashlib.md5("\n".join(vocabulary).encode())
+    md5.update(np.ascontiguousarray(model.wv[vocabulary], dtype=np.float32).view(np.uint8))
+    return md5.hexdigest()[:16]
+
+def project_2d(model, method='pca', folder=None, seed=1):
+    """
+    2D coordinates of every event of model, as the map2D dict that
+    slap.plotpathways and plotendpoints_alivedead take.
+
+    method: 'pca' (numpy only) or 'umap' (needs umap-learn)
+    If folder is given the projection is saved there, named by a hash of
+    the model's vectors, and reused.
+    """
+    if method not in projection_methods:
+        raise ValueError("method must be one of " + str(projection_methods))
+    projection_path = None
+    if folder is not None:
+        projection_path = os.path.join(folder, "map2D." + _hash(vectors_key(model), method, seed) + ".pkl")
+        if os.path.exists(projection_path):
+            with open(projection_path, "rb") as f:
+                return pickle.load(f)
+    vocabulary = _vocabulary(model)
+    vectors = np.asarray(model.wv[vocabulary], dtype=float)
+    if method == 'pca':
+        centred = vectors - vectors.mean(axis=0)
+        u, s, vt = np.linalg.svd(centred, full_matrices=False)
+        coordinates = centred.dot(vt[:2].T)
+    else:
+        import umap
+        coordinates = umap.UMAP(n_components=2, random_state=seed).fit_transform(vectors)
+    map2D = dict(zip(vocabulary, coordinates))
+    if projection_path is not None:
+        _save_pickle(map2D, projection_path)
+    return map2D
+
+def event_vector_frame(map2D, store):
+    """
+    Dataframe with columns 'event_label', 'x', 'y', 'event_type' and 'event'
+    for slap.plotevents, for the events of a SequenceStore.
+    """
+    vocabulary = [event for event in store.vocabulary if event in map2D]
+    types = dict(zip(store.vocabulary, store.vocabulary_types))
+    coordinates = np.array([map2D[event] for event in vocabulary]).reshape(-1, 2)
+    df = pd.DataFrame({'event_label': vocabulary,
+                       'x': coordinates[:, 0],
+                       'y': coordinates[:, 1],
+                       'event_type': [types[event] for event in vocabulary]})
+    df['event'] = [event[len(event_type)+1:] for event, event_type in zip(df['event_label'], df['event_type'])]
+    return df
+
+def _word2vec(corpus, vector_size, epochs, **kwargs):
+    import gensim
+    from gensim.models import Word2Vec
+    # gensim 4 renamed size and iter
+    if int(gensim.__version__.split(".")[0]) >= 4:
+        return Word2Vec(sentences=corpus, vector_size=vector_size, epochs=epochs, **kwargs)
+    return Word2Vec(sentences=corpus, size=vector_size, iter=epochs, **kwargs)
+
+def _vocabulary(model):
+    if hasattr(model.wv, "index_to_key"):
+        return list(model.wv.index_to_key)
+    return list(model.wv.index2word)
+
+def _hash(*values):
+    return hashlib.md5(repr(values).encode()).hexdigest()[:16]
+
+def _save(model, model_path):
+    folder = os.path.dirname(model_path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    model.save(model_path)
+
+def _save_pickle(value, path):
+    folder = os.path.dirname(path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    with open(path, "wb") as f:
+        pickle.dump(value, f)
@@ -0,0 +1,114 @@
+"""
+module for TF-IDF features and clusters of pathway event sequences
+Version 1.1.0
+for use with simulacrum_release_v1.1.0
+"""
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from sklearn.utils.extmath import randomized_svd
+from sklearn.cluster import MiniBatchKMeans
+
+
+def document_term_matrix(store, ngrams=(1, 2)):
+    """
+    Sparse CSR matrix with a row per sequence of store (a SequenceStore) and
+    a column per term, counting how often each term appears in the sequence.
+    Terms are the events and runs of consecutive events (n-grams) with
+    lengths from ngrams[0] to ngrams[1], worked out on the integer tokens.
+
+    Returns the matrix and the list of terms (n-grams joined by ' -> ').
+    """
+    lengths = store.lengths()
+    sequence_of_event = np.repeat(np.arange(len(store)), lengths)
+    tokens = np.asarray(store.tokens, dtype=np.int64)
+    n_events = len(store.vocabulary)
+    rows, keys, term_lengths = [], [], []
+    for n in range(ngrams[0], ngrams[1] + 1):
+        if float(n_events + 1)**n > 2**62:
+            raise ValueError("Too many events to code " + str(n) + "-grams as integers.")
+        # n-grams start at events with n-1 more events of the same sequence after them
+        starts = np.arange(max(len(tokens) - n + 1, 0))
+        starts = starts[sequence_of_event[starts] == sequence_of_event[starts + n - 1]]
+        key = np.zeros(len(starts), dtype=np.int64)
+        for j in range(n):
+            key = key*(n_events + 1) + tokens[starts + j] + 1
+        rows.append(sequence_of_event[starts])
+        keys.append(key)
+        term_lengths.append(np.full(len(starts), n))
+    rows = np.concatenate(rows)
+    # n-grams of different lengths can't share a key as no token codes to 0
+    columns, unique_keys = pd.factorize(np.concatenate(keys), sort=True)
+    matrix = scipy.sparse.csr_matrix((np.ones(len(rows)), (rows, columns)),
+                                     shape=(len(store), len(unique_keys)))
+    matrix.sum_duplicates()
+    return matrix, [_term(key, store.vocabulary, n_events) for key in unique_keys]
+
+def tfidf(matrix, copy=False):
+    """
+    TF-IDF weighting of a document-term matrix (counts times the smoothed
+    inverse document frequency log((1+n)/(1+df))+1, with each row scaled to
+    unit length), done on the data of the CSR matrix in place unless copy.
+    """
+    if copy:
+        matrix = matrix.copy()
+    matrix = matrix.tocsr()
+    n_documents = matrix.shape[0]
+    document_frequency = np.bincount(matrix.indices, minlength=matrix.shape[1])
+    idf = np.log((1 + n_documents)/(1 + document_frequency)) + 1
+    matrix.data *= idf[matrix.indices]
+    # row lengths, taking care of empty rows
+    row_lengths = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    row_lengths[row_lengths == 0] = 1
+    matrix.data /= np.repeat(row_lengths, np.diff(matrix.indptr))
+    return matrix
+
+def reduce_dimensions(matrix, n_components=10, seed=1):
+    """
+    Coordinates of the rows of a (sparse) matrix along its top n_components
+    singular vectors, by randomized truncated SVD.
+    """
+    u, s, vt = randomized_svd(matrix, n_components, random_state=seed)
+    return u*s
+
+def cluster(coordinates, n_clusters=5, batch_size=1024, seed=1):
+    """
+    Cluster labels of the rows of coordinates by mini-batch k-means, which
+    only works on batch_size rows at a time.
+    """
+    model = MiniBatchKMeans(n_clusters=n_clusters, batch_size=batch_size,
+                            random_state=seed, n_init=3)
+    return model.fit_predict(coordinates)
+
+def sequence_clusters(store,
+                      single_cancer=None,
+                      n_clusters=5,
+                      n_components=10,
+                      ngrams=(1, 2),
+                      batch_size=1024,
+                      seed=1):
+    """
+    Clusters the sequences of a SequenceStore (of one PRIMARY_DIAGNOSIS
+    if single_cancer is given) by their TF-IDF features.
+
+    Returns a dataframe with the rows of store plus 'sequence',
+    'sequence_days', 'cluster' and the first two SVD coordinates as 'x' and
+    'y', as slap.sequenceclusterplot and clusterinfo take.
+    """
+    if single_cancer is not None:
+        store = store.select(diagnoses=[single_cancer])
+    matrix, terms = document_term_matrix(store, ngrams)
+    coordinates = reduce_dimensions(tfidf(matrix), min(n_components, max(min(matrix.shape) - 1, 1)), seed)
+    df = store.to_frame()
+    df['cluster'] = cluster(coordinates, n_clusters, batch_size, seed)
+    df['x'] = coordinates[:, 0]
+    df['y'] = coordinates[:, 1] if coordinates.shape[1] > 1 else 0
+    return df
+
+def _term(key, vocabulary, n_events):
+    events = []
+    while key:
+        events.append(vocabulary[key % (n_events + 1) - 1])
+        key //= n_events + 1
+    return " -> ".join(events[::-1])
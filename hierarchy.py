@@ -0,0 +1,263 @@
+"""
+module for the SACT ID hierarchy: patient -> tumour -> regimen -> cycle -> drug detail
+Version 1.1.0
+for use with simulacrum_release_v1.1.0
+"""
+
+import os
+import numpy as np
+import pandas as pd
+import load
+
+levels = ['patient', 'tumour', 'regimen', 'cycle', 'drug_detail']
+
+# date of each ID, for the levels that have one
+level_dates = {
+    'regimen' : 'START_DATE_OF_REGIMEN',
+    'cycle' : 'START_DATE_OF_CYCLE',
+    'drug_detail' : 'ADMINISTRATION_DATE'
+}
+
+rollup_options = ['count', 'sum', 'min', 'max']
+
+
+def id_column(level):
+    """
+    The ID column of a level, e.g. MERGED_TUMOUR_ID for 'tumour'.
+    """
+    return "MERGED_" + level.upper() + "_ID"
+
+
+class IDHierarchy(object):
+
+    """
+    The MERGED_*_ID hierarchy of the SACT tables in flat integer arrays.
+    For each level:
+
+    - ids[level]: the sorted distinct IDs
+    - parents[level]: position in ids of the level above of each ID's parent
+      (-1 for patients, and for IDs whose parent is not in the table above)
+    - child_offsets[level], children[level]: the children of ids[level][i] are
+      at positions children[level][child_offsets[level][i]:child_offsets[level][i+1]]
+      in ids of the level below
+    - dates[level]: date of each ID (see level_dates), or None
+
+    Build one from the tables with from_tables.
+    """
+
+    def __init__(self, ids, parents, child_offsets, children, dates):
+        self.ids = ids
+        self.parents = parents
+        self.child_offsets = child_offsets
+        self.children = children
+        self.dates = dates
+
+    @classmethod
+    def from_tables(cls, tables=None, folder=load.default_folder, prefix=load.default_prefix):
+        """
+        Builds the hierarchy from the SACT tables, loading just the ID and
+        date columns of any not given in tables (a dict like load.all_tables).
+        """
+        tables = tables or {}
+        ids, parents, child_offsets, children, dates = {}, {}, {}, {}, {}
+        for i, level in enumerate(levels):
+            columns = [id_column(level)]
+            if i > 0:
+                columns.append(id_column(levels[i-1]))
+            if level in level_dates:
+                columns.append(level_dates[level])
+            table_name = 'sact_' + level
+            if table_name in tables:
+                table = tables[table_name][columns]
+            else:
+                table = load.load_table(table_name, columns=columns, folder=folder, prefix=prefix)
+            level_ids, first = np.unique(table[id_column(level)].values, return_index=True)
+            ids[level] = level_ids
+            dates[level] = table[level_dates[level]].values[first] if level in level_dates else None
+            if i == 0:
+                parents[level] = np.full(len(level_ids), -1, dtype=np.int64)
+            else:
+                parents[level] = _positions(ids[levels[i-1]], table[id_column(levels[i-1])].values[first])
+        for i, level in enumerate(levels[:-1]):
+            child_parents = parents[levels[i+1]]
+            order = np.argsort(child_parents, kind='mergesort')
+            order = order[child_parents[order] >= 0]
+            children[level] = order.astype(np.int64)
+            child_offsets[level] = np.searchsorted(child_parents[order], np.arange(len(ids[level]) + 1)).astype(np.int64)
+        return cls(ids, parents, child_offsets, children, dates)
+
+    def positions(self, level, ids):
+        """
+        Positions of ids in self.ids[level], -1 for IDs not there.
+        """
+        return _positions(self.ids[level], np.atleast_1d(ids))
+
+    def children_of(self, level, ids):
+        """
+        IDs of the level below that are children of ids.
+        """
+        positions = self.positions(level, ids)
+        child_level = levels[levels.index(level) + 1]
+        return self.ids[child_level][self._child_positions(level, positions[positions >= 0])]
+
+    def descendants(self, level, ids):
+        """
+        Dict of the IDs at each level below level that descend from ids.
+        """
+        positions = self.positions(level, ids)
+        positions = positions[positions >= 0]
+        found = {}
+        for i in range(levels.index(level), len(levels) - 1):
+            positions = self._child_positions(levels[i], positions)
+            found[levels[i+1]] = self.ids[levels[i+1]][positions]
+        return found
+
+    def ancestors(self, level, ids, to_level):
+        """
+        IDs at to_level (above level) that ids descend from, -1 where unknown.
+        """
+        positions = self._ancestor_positions(level, self.positions(level, ids), to_level)
+        return np.where(positions >= 0, self.ids[to_level][positions], -1)
+
+    def rollup(self, from_level, to_level, values=None, how='count'):
+        """
+        Aggregates a value of every ID at from_level up to its ancestor at
+        to_level, e.g. the number of drug details of each patient
+        (values=None, how='count') or the date of their first administration
+        (values='date', how='min').
+
+        values: array aligned with ids[from_level], 'date' for the dates of
+                from_level, or None (only for how='count')
+        how: one of rollup_options
+        Returns a series indexed by the IDs of to_level (0 or NaN/NaT where
+        there is nothing to aggregate).
+        """
+        if how not in rollup_options:
+            raise ValueError("how must be one of " + str(rollup_options))
+        ancestors = self._ancestor_positions(from_level, np.arange(len(self.ids[from_level])), to_level)
+        index = pd.Index(self.ids[to_level], name=id_column(to_level))
+        known = ancestors >= 0
+        if how == 'count':
+            weights = None
+            if values is not None:
+                weights = pd.notna(self._values(from_level, values))[known]
+            counts = np.bincount(ancestors[known], weights=weights, minlength=len(index))
+            return pd.Series(counts.astype(np.int64), index=index)
+        values = pd.Series(self._values(from_level, values)[known])
+        aggregated = values.groupby(ancestors[known]).agg(how)
+        return pd.Series(aggregated.reindex(np.arange(len(index))).values, index=index)
+
+    def how_many_per(self, big_level, small_level, include_empty=False):
+        """
+        Number of small_level IDs under each big_level ID, e.g.
+        how_many_per('tumour', 'regimen'). Use .describe() or a histogram
+        to see the distribution. IDs with none are left out unless
+        include_empty=True.
+        """
+        counts = self.rollup(small_level, big_level)
+        if not include_empty:
+            counts = counts[counts > 0]
+        return counts
+
+    def to_networkx(self, level, ids):
+        """
+        networkx DiGraph of ids and all their descendants, with nodes named
+        like 'tumour_10000006' and a 'position' attribute of (level number,
+        date as an integer) for the levels with dates, except for nodes with
+        a missing date. Meant for small subgraphs, e.g. the pathway of one
+        tumour.
+        """
+        import networkx as nx
+        graph = nx.DiGraph()
+        positions = self.positions(level, ids)
+        positions = positions[positions >= 0]
+        graph.add_nodes_from(level + "_" + str(i) for i in self.ids[level][positions])
+        for i in range(levels.index(level), len(levels)):
+            node_level = levels[i]
+            node_names = [node_level + "_" + str(node_id) for node_id in self.ids[node_level][positions]]
+            if self.dates[node_level] is not None:
+                dates = np.asarray(self.dates[node_level][positions]).astype('datetime64[ns]')
+                # nodes with no date get no position
+                for name, known, time in zip(node_names, ~np.isnat(dates), dates.astype(np.int64)):
+                    if known:
+                        graph.add_node(name, position=(i, int(time)))
+            if i == len(levels) - 1:
+                break
+            child_level = levels[i+1]
+            child_positions = self._child_positions(node_level, positions)
+            parent_names = [node_level + "_" + str(parent_id) for parent_id
+                            in self.ids[node_level][self.parents[child_level][child_positions]]]
+            graph.add_edges_from(zip(parent_names,
+                                     [child_level + "_" + str(child_id)
+                                      for child_id in self.ids[child_level][child_positions]]))
+            positions = child_positions
+        return graph
+
+    def save(self, folder):
+        """
+        Saves the hierarchy to a folder as .npy arrays.
+        """
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        for name in ['ids', 'parents', 'child_offsets', 'children', 'dates']:
+            for level, array in getattr(self, name).items():
+                if array is not None:
+                    np.save(os.path.join(folder, name + "_" + level + ".npy"), array)
+
+    @classmethod
+    def load(cls, folder, mmap_mode='r'):
+        """
+        Loads a hierarchy saved with save, memory-mapped by default.
+        """
+        arrays = {}
+        for name in ['ids', 'parents', 'child_offsets', 'children', 'dates']:
+            arrays[name] = {}
+            for level in levels:
+                read_path = os.path.join(folder, name + "_" + level + ".npy")
+                if os.path.exists(read_path):
+                    arrays[name][level] = np.load(read_path, mmap_mode=mmap_mode)
+                elif name == 'dates':
+                    arrays[name][level] = None
+                elif name in ['ids', 'parents'] or level != levels[-1]:
+                    raise ValueError("The file " + read_path + " does not exist.")
+        return cls(**arrays)
+
+    def _child_positions(self, level, positions):
+        offsets = self.child_offsets[level]
+        starts = offsets[positions]
+        counts = offsets[positions + 1] - starts
+        ends = np.cumsum(counts)
+        # index into children of every child, counting up from each parent's first child
+        index = np.repeat(starts - (ends - counts), counts) + np.arange(ends[-1] if len(ends) else 0)
+        return self.children[level][index]
+
+    def _ancestor_positions(self, level, positions, to_level):
+        if levels.index(to_level) > levels.index(level):
+            raise ValueError(to_level + " is not above " + level)
+        positions = np.asarray(positions)
+        for i in range(levels.index(level), levels.index(to_level), -1):
+            parents = self.parents[levels[i]]
+            positions = np.where(positions >= 0, parents[np.maximum(positions, 0)], -1)
+        return positions
+
+    def _values(self, level, values):
+        if values is None:
+            raise ValueError("values are needed for this rollup")
+        if isinstance(values, str) and values == 'date':
+            if self.dates[level] is None:
+                raise ValueError(level + " has no dates")
+            return np.asarray(self.dates[level])
+        return np.asarray(values)
+
+
+def _positions(sorted_ids, ids):
+    """
+    Positions of ids in sorted_ids, -1 for IDs not there.
+    """
+    ids = np.asarray(ids)
+    positions = np.searchsorted(sorted_ids, ids)
+    positions[positions == len(sorted_ids)] = 0
+    found = np.zeros(len(ids), dtype=bool)
+    if len(sorted_ids):
+        found = sorted_ids[positions] == ids
+    return np.where(found, positions, -1)
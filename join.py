@@ -0,0 +1,256 @@
+"""
+module for joining the tables along their ID keys
+Version 1.1.0
+for use with simulacrum_release_v1.1.0
+"""
+
+import os
+import numpy as np
+import pandas as pd
+import load
+
+# the columns that link pairs of tables
+join_keys = {
+    ('av_patient', 'av_tumour') : ('PATIENTID', 'PATIENTID'),
+    ('av_patient', 'sact_patient') : ('LINKNUMBER', 'LINK_NUMBER'),
+    ('av_tumour', 'sact_patient') : ('LINK_NUMBER', 'LINK_NUMBER'),
+    ('sact_patient', 'sact_tumour') : ('MERGED_PATIENT_ID', 'MERGED_PATIENT_ID'),
+    ('sact_tumour', 'sact_regimen') : ('MERGED_TUMOUR_ID', 'MERGED_TUMOUR_ID'),
+    ('sact_regimen', 'sact_outcome') : ('MERGED_REGIMEN_ID', 'MERGED_REGIMEN_ID'),
+    ('sact_regimen', 'sact_cycle') : ('MERGED_REGIMEN_ID', 'MERGED_REGIMEN_ID'),
+    ('sact_cycle', 'sact_drug_detail') : ('MERGED_CYCLE_ID', 'MERGED_CYCLE_ID')
+}
+
+join_options = ['inner', 'left']
+
+
+class KeyIndex(object):
+
+    """
+    Sorted index of a key column (e.g. MERGED_TUMOUR_ID): the rows with
+    the i-th smallest distinct key are order[offsets[i]:offsets[i+1]].
+    Missing keys are left out.
+    """
+
+    def __init__(self, values):
+        values = np.asarray(values)
+        present = np.flatnonzero(~pd.isna(values))
+        order = present[np.argsort(values[present], kind='mergesort')]
+        sorted_values = values[order]
+        new_key = np.ones(len(order), dtype=bool)
+        new_key[1:] = sorted_values[1:] != sorted_values[:-1]
+        starts = np.flatnonzero(new_key)
+        self.keys = sorted_values[starts]
+        self.offsets = np.append(starts, len(order)).astype(np.int64)
+        self.order = order.astype(np.int64)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, values):
+        """
+        Rows matching each of values. Returns (left, right) position arrays:
+        values[left[j]] is the key of row right[j]. left is in increasing order.
+        """
+        values = np.asarray(values)
+        i = np.searchsorted(self.keys, values)
+        i[i == len(self.keys)] = 0
+        found = np.zeros(len(values), dtype=bool)
+        if len(self.keys):
+            found = self.keys[i] == values
+        counts = np.where(found, self.offsets[i+1] - self.offsets[i], 0)
+        left = np.repeat(np.arange(len(values)), counts)
+        # position in order of every match, counting up from each key's first row
+        ends = np.cumsum(counts)
+        sorted_positions = np.repeat(self.offsets[i] - (ends - counts), counts) + np.arange(ends[-1] if len(ends) else 0)
+        return left, self.order[sorted_positions]
+
+
+# KeyIndex of each (source, column) built so far
+key_index_cache = {}
+
+# columns loaded by join_path(cache_columns=True), by source (csv path,
+# modification time) and column
+loaded_columns = {}
+
+def key_index(table, column, source=None):
+    """
+    KeyIndex of table[column]. If source (the csv path and modification time
+    the table was loaded from) is given the index is built the first time it
+    is asked for and reused for as long as source stays the same. Otherwise
+    it is built every time, as a table in memory can be changed in place.
+    """
+    if source is None:
+        return KeyIndex(table[column].values)
+    key = (source, column)
+    index = key_index_cache.get(key)
+    if index is None:
+        index = key_index_cache[key] = KeyIndex(table[column].values)
+    return index
+
+def clear_key_index_cache():
+    """
+    Forget all the key indexes built so far, and the columns join_path
+    loaded.
+    """
+    key_index_cache.clear()
+    loaded_columns.clear()
+
+def get_join_key(table_name_1, table_name_2):
+    """
+    (column of table 1, column of table 2) that links the two tables, or None.
+    """
+    if (table_name_1, table_name_2) in join_keys:
+        return join_keys[(table_name_1, table_name_2)]
+    if (table_name_2, table_name_1) in join_keys:
+        return join_keys[(table_name_2, table_name_1)][::-1]
+    return None
+
+def join_path(path,
+              columns=None,
+              tables=None,
+              how='inner',
+              cache_columns=False,
+              folder=load.default_folder,
+              prefix=load.default_prefix):
+    """
+    Joins the tables in path one after another along their ID keys (see
+    join_keys), each to the nearest table before it in path that it links to:
+
+        join_path(['av_patient', 'av_tumour', 'sact_patient', 'sact_tumour',
+                   'sact_regimen'],
+                  columns=['PATIENTID', 'SITE_ICD10_O2_3CHAR',
+                           'PRIMARY_DIAGNOSIS', 'BENCHMARK_GROUP'])
+
+    The joins are done on row positions with a sorted KeyIndex of each key
+    column (built once and reused for the tables loaded here), and only the requested columns are taken
+    from each table at the end, so there are no _x/_y copies of columns.
+
+    columns: columns to return. 'table.COLUMN' (e.g. 'av_tumour.SEX') is
+             COLUMN of that table and plain 'COLUMN' comes from the first table
+             in path that has it. By default all the columns of every table,
+             where a name already taken by an earlier table is given as
+             'table.COLUMN'.
+    tables: dict of tables that are already loaded, by name. The others are
+            loaded with load.load_table, with just the columns needed.
+    how: 'inner' or 'left' (keep rows that have no match in the next table)
+    cache_columns: keep the loaded columns in loaded_columns for later calls,
+                   until the csv changes or clear_key_index_cache is called.
+                   Saves parsing the csvs again, but holds the columns in
+                   memory for the rest of the session.
+    """
+    if how not in join_options:
+        raise ValueError("how must be one of " + str(join_options))
+    path = [table_name.lower() for table_name in path]
+    if len(set(path)) < len(path):
+        raise ValueError("path must not repeat a table")
+    tables = dict(tables or {})
+
+    # key columns of each step
+    steps = []
+    for j, table_name in enumerate(path[1:], 1):
+        for previous in path[j-1::-1]:
+            join_key = get_join_key(previous, table_name)
+            if join_key is not None:
+                steps.append((previous, table_name) + join_key)
+                break
+        else:
+            raise ValueError("No table before " + table_name + " in path links to it.")
+
+    # columns to take from each table
+    table_columns = {table_name: _table_columns(table_name, tables) for table_name in path}
+    output = []
+    if columns is None:
+        for table_name in path:
+            for column in table_columns[table_name]:
+                name = column
+                if any(column == output_column for output_column, _, _ in output):
+                    name = table_name + "." + column
+                output.append((name, table_name, column))
+        # a key column joined on equal values only needs keeping once
+        key_columns = set((right, right_column) for left, right, left_column, right_column in steps
+                          if left_column == right_column)
+        output = [(name, table_name, column) for name, table_name, column in output
+                  if (table_name, column) not in key_columns or name == column]
+    else:
+        for name in columns:
+            table_name, column = _find_column(name, path, table_columns)
+            output.append((name, table_name, column))
+
+    # load what is needed of the tables not given
+    source = {}
+    for table_name in path:
+        if table_name in tables:
+            continue
+        needed = [column for _, name, column in output if name == table_name]
+        needed += [left_column for left, _, left_column, _ in steps if left == table_name]
+        needed += [right_column for _, right, _, right_column in steps if right == table_name]
+        needed = list(dict.fromkeys(needed))
+        tables[table_name], source[table_name] = _load_columns(table_name, needed, cache_columns,
+                                                               folder, prefix)
+
+    # join on row positions, -1 is a row with no match (how='left')
+    positions = {path[0]: np.arange(len(tables[path[0]]), dtype=np.int64)}
+    for left, right, left_column, right_column in steps:
+        left_values = _take(tables[left][left_column], positions[left])
+        index = key_index(tables[right], right_column, source.get(right))
+        rows, right_positions = index.lookup(left_values)
+        if how == 'left':
+            unmatched = np.setdiff1d(np.arange(len(left_values)), rows)
+            rows = np.concatenate([rows, unmatched])
+            right_positions = np.concatenate([right_positions, np.full(len(unmatched), -1, dtype=np.int64)])
+            order = np.argsort(rows, kind='mergesort')
+            rows, right_positions = rows[order], right_positions[order]
+        positions = {table_name: table_positions[rows] for table_name, table_positions in positions.items()}
+        positions[right] = right_positions
+
+    return pd.DataFrame({name: _take(tables[table_name][column], positions[table_name])
+                         for name, table_name, column in output},
+                        columns=[name for name, _, _ in output])
+
+def _load_columns(table_name, columns, cache_columns, folder, prefix):
+    """
+    The columns of a table as a dataframe, and the (csv path, modification
+    time) they came from. With cache_columns only those not already in
+    loaded_columns are loaded, and they are added to it.
+    """
+    read_path = load.table_path(table_name, folder, prefix)
+    if not os.path.exists(read_path):
+        raise ValueError("The file " + read_path + " does not exist.")
+    source = (read_path, os.stat(read_path).st_mtime_ns)
+    # forget what was loaded from older versions of the csv
+    for stale in [key for key in loaded_columns if key[0] == read_path and key != source]:
+        del loaded_columns[stale]
+    for stale in [key for key in key_index_cache if key[0][0] == read_path and key[0] != source]:
+        del key_index_cache[stale]
+    if not cache_columns:
+        return load.load_table(table_name, columns=columns, folder=folder, prefix=prefix), source
+    cached = loaded_columns.setdefault(source, {})
+    missing = [column for column in columns if column not in cached]
+    if missing:
+        table = load.load_table(table_name, columns=missing, folder=folder, prefix=prefix)
+        cached.update({column: table[column] for column in missing})
+    return pd.DataFrame({column: cached[column] for column in columns}, copy=False), source
+
+def _table_columns(table_name, tables):
+    if table_name in tables:
+        return list(tables[table_name].columns)
+    if table_name in load.default_dtypes:
+        return list(load.default_dtypes[table_name])
+    return list(load.load_table(table_name).columns)
+
+def _find_column(name, path, table_columns):
+    if "." in name:
+        table_name, column = name.split(".", 1)
+        if table_name in path and column in table_columns[table_name]:
+            return table_name, column
+    for table_name in path:
+        if name in table_columns[table_name]:
+            return table_name, name
+    raise ValueError("No table in path has a column " + name + ".")
+
+def _take(values, positions):
+    """
+    values at positions, with missing values where a position is -1.
+    """
+    return pd.api.extensions.take(values.array, positions, allow_fill=True)
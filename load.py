@@ -5,6 +5,12 @@ for use with simulacrum_release_v1.1.0
 """
 
 import os
+import io
+import glob
+import time
+import hashlib
+import concurrent.futures
+import numpy as np
 import pandas as pd
 
 default_folder="../simulacrum_release_v1.1.0"
@@ -21,141 +27,191 @@ table_names = [
     'sact_tumour'
 ]
 
+# placeholder dates that mean the real date is unknown, see parse_date_columns
+default_date_sentinels = ['1900-01-01']
+bad_date_options = ['keep', 'nat', 'flag']
+
+# type profiles for load_table, see compact_table
+profiles = ['default', 'compact']
+
+# tables big enough to be worth splitting across processes in all_tables
+default_split_tables = ['sact_cycle', 'sact_drug_detail']
+
+default_dtypes = {
+    'av_patient' : {
+        'PATIENTID' : int,
+        'SEX' : 'category',
+        'LINKNUMBER' : int,
+        'ETHNICITY' : 'category',
+        'DEATHCAUSECODE_1A' : object,
+        'DEATHCAUSECODE_1B' : object,
+        'DEATHCAUSECODE_1C' : object,
+        'DEATHCAUSECODE_2' : object,
+        'DEATHCAUSECODE_UNDERLYING' : object,
+        'DEATHLOCATIONCODE' : 'category',
+        'NEWVITALSTATUS' : 'category',
+        'VITALSTATUSDATE': object
+    },
+    'av_tumour' : {
+        'TUMOURID' : int,
+        'PATIENTID' : int,
+        'DIAGNOSISDATEBEST' : object,
+        'SITE_ICD10_O2' : 'category',
+        'SITE_ICD10_O2_3CHAR' : 'category',
+        'MORPH_ICD10_O2' : 'category',
+        'BEHAVIOUR_ICD10_O2' : 'category',
+        'T_BEST' : 'category',
+        'N_BEST' : 'category',
+        'M_BEST' : 'category',
+        'STAGE_BEST' : 'category',
+        'STAGE_BEST_SYSTEM' : 'category',
+        'GRADE' : 'category',
+        'AGE' : float,
+        'SEX' : 'category',
+        'CREG_CODE' : 'category',
+        'LINK_NUMBER' : int,
+        'SCREENINGSTATUSFULL_CODE' : 'category',
+        'ER_STATUS' : 'category',
+        'ER_SCORE' : 'category',
+        'PR_STATUS' : 'category',
+        'PR_SCORE' : 'category',
+        'HER2_STATUS' : 'category',
+        'CANCERCAREPLANINTENT' : 'category',
+        'PERFORMANCESTATUS' : 'category',
+        'CNS' : 'category',
+        'ACE27' : 'category',
+        'GLEASON_PRIMARY' : 'category',
+        'GLEASON_SECONDARY' : 'category',
+        'GLEASON_TERTIARY' : 'category',
+        'GLEASON_COMBINED' : 'category',
+        'DATE_FIRST_SURGERY' : object,
+        'LATERALITY' : 'category',
+        'QUINTILE_2015' : 'category'
+    },
+    'sact_cycle' : {
+        'MERGED_CYCLE_ID' : int,
+        'MERGED_REGIMEN_ID' : int,
+        'CYCLE_NUMBER' : int,
+        'START_DATE_OF_CYCLE' : object,
+        'OPCS_PROCUREMENT_CODE' : 'category',
+        'PERF_STATUS_START_OF_CYCLE' : 'category',
+        'MERGED_PATIENT_ID' : int,
+        'MERGED_TUMOUR_ID' : int
+    },
+    'sact_drug_detail' : {
+        'MERGED_DRUG_DETAIL_ID' : int,
+        'MERGED_CYCLE_ID' : int,
+        'ORG_CODE_OF_DRUG_PROVIDER' : 'category',
+        'ACTUAL_DOSE_PER_ADMINISTRATION' : float,
+        'OPCS_DELIVERY_CODE' : 'category',
+        'ADMINISTRATION_ROUTE' : 'category',
+        'ADMINISTRATION_DATE' : object,
+        'DRUG_GROUP' : 'category',
+        'MERGED_PATIENT_ID' : int,
+        'MERGED_TUMOUR_ID' : int,
+        'MERGED_REGIMEN_ID' : int
+    },
+    'sact_outcome' : {
+        'MERGED_OUTCOME_ID' : int,
+        'MERGED_REGIMEN_ID' : int,
+        'DATE_OF_FINAL_TREATMENT' : object,
+        'REGIMEN_MOD_DOSE_REDUCTION' : 'category',
+        'REGIMEN_MOD_TIME_DELAY' : 'category',
+        'REGIMEN_MOD_STOPPED_EARLY' : 'category',
+        'REGIMEN_OUTCOME_SUMMARY' : 'category',
+        'MERGED_PATIENT_ID' : int,
+        'MERGED_TUMOUR_ID' : int
+    },
+    'sact_patient' : {
+        'MERGED_PATIENT_ID' : int,
+        'LINK_NUMBER' : int
+    },
+    'sact_regimen' : {
+        'MERGED_REGIMEN_ID' : int,
+        'MERGED_TUMOUR_ID' : int,
+        'HEIGHT_AT_START_OF_REGIMEN' : float,
+        'WEIGHT_AT_START_OF_REGIMEN' : float,
+        'INTENT_OF_TREATMENT' : 'category',
+        'DATE_DECISION_TO_TREAT' : object,
+        'START_DATE_OF_REGIMEN' : object,
+        'MAPPED_REGIMEN' : object,
+        'CLINICAL_TRIAL' : 'category',
+        'CHEMO_RADIATION' : 'category',
+        'MERGED_PATIENT_ID' : int,
+        'BENCHMARK_GROUP' : 'category'
+    },
+    'sact_tumour' : {
+        'MERGED_TUMOUR_ID' : int,
+        'MERGED_PATIENT_ID' : int,
+        'CONSULTANT_SPECIALITY_CODE' : 'category',
+        'PRIMARY_DIAGNOSIS' : 'category',
+        'MORPHOLOGY_CLEAN' : 'category'
+    }
+}
+default_dates = {
+    'av_patient' : ['VITALSTATUSDATE'],
+    'av_tumour' : ['DIAGNOSISDATEBEST', 'DATE_FIRST_SURGERY'],
+    'sact_cycle' : ['START_DATE_OF_CYCLE'],
+    'sact_drug_detail' : ['ADMINISTRATION_DATE'],
+    'sact_outcome' : ['DATE_OF_FINAL_TREATMENT'],
+    'sact_patient' : [],
+    'sact_regimen' : ['DATE_DECISION_TO_TREAT', 'START_DATE_OF_REGIMEN'],
+    'sact_tumour' : []
+}
+
 def load_table(table_name,
                dtype=None,
                parse_dates=None,
                add_descriptions=False,
                folder=default_folder,
-               prefix=default_prefix):
+               prefix=default_prefix,
+               cache=True,
+               columns=None,
+               filters=None,
+               profile='default',
+               bad_dates='keep',
+               return_report=False):
     """
     Loads specified table and returns it.
 
     For the standard tables loads them with recommended types for each column.
 
     Option to add all available descriptions.
-    """
 
-    default_dtypes = {
-        'av_patient' : {
-            'PATIENTID' : int,
-            'SEX' : 'category',
-            'LINKNUMBER' : int,
-            'ETHNICITY' : 'category',
-            'DEATHCAUSECODE_1A' : object,
-            'DEATHCAUSECODE_1B' : object,
-            'DEATHCAUSECODE_1C' : object,
-            'DEATHCAUSECODE_2' : object,
-            'DEATHCAUSECODE_UNDERLYING' : object,
-            'DEATHLOCATIONCODE' : 'category',
-            'NEWVITALSTATUS' : 'category',
-            'VITALSTATUSDATE': object
-        },
-        'av_tumour' : {
-            'TUMOURID' : int,
-            'PATIENTID' : int,
-            'DIAGNOSISDATEBEST' : object,
-            'SITE_ICD10_O2' : 'category',
-            'SITE_ICD10_O2_3CHAR' : 'category',
-            'MORPH_ICD10_O2' : 'category',
-            'BEHAVIOUR_ICD10_O2' : 'category',
-            'T_BEST' : 'category',
-            'N_BEST' : 'category',
-            'M_BEST' : 'category',
-            'STAGE_BEST' : 'category',
-            'STAGE_BEST_SYSTEM' : 'category',
-            'GRADE' : 'category',
-            'AGE' : float,
-            'SEX' : 'category',
-            'CREG_CODE' : 'category',
-            'LINK_NUMBER' : int,
-            'SCREENINGSTATUSFULL_CODE' : 'category',
-            'ER_STATUS' : 'category',
-            'ER_SCORE' : 'category',
-            'PR_STATUS' : 'category',
-            'PR_SCORE' : 'category',
-            'HER2_STATUS' : 'category',
-            'CANCERCAREPLANINTENT' : 'category',
-            'PERFORMANCESTATUS' : 'category',
-            'CNS' : 'category',
-            'ACE27' : 'category',
-            'GLEASON_PRIMARY' : 'category',
-            'GLEASON_SECONDARY' : 'category',
-            'GLEASON_TERTIARY' : 'category',
-            'GLEASON_COMBINED' : 'category',
-            'DATE_FIRST_SURGERY' : object,
-            'LATERALITY' : 'category',
-            'QUINTILE_2015' : 'category'
-        },
-        'sact_cycle' : {
-            'MERGED_CYCLE_ID' : int,
-            'MERGED_REGIMEN_ID' : int,
-            'CYCLE_NUMBER' : int,
-            'START_DATE_OF_CYCLE' : object,
-            'OPCS_PROCUREMENT_CODE' : 'category',
-            'PERF_STATUS_START_OF_CYCLE' : 'category',
-            'MERGED_PATIENT_ID' : int,
-            'MERGED_TUMOUR_ID' : int
-        },
-        'sact_drug_detail' : {
-            'MERGED_DRUG_DETAIL_ID' : int,
-            'MERGED_CYCLE_ID' : int,
-            'ORG_CODE_OF_DRUG_PROVIDER' : 'category',
-            'ACTUAL_DOSE_PER_ADMINISTRATION' : float,
-            'OPCS_DELIVERY_CODE' : 'category',
-            'ADMINISTRATION_ROUTE' : 'category',
-            'ADMINISTRATION_DATE' : object,
-            'DRUG_GROUP' : 'category',
-            'MERGED_PATIENT_ID' : int,
-            'MERGED_TUMOUR_ID' : int,
-            'MERGED_REGIMEN_ID' : int
-        },
-        'sact_outcome' : {
-            'MERGED_OUTCOME_ID' : int,
-            'MERGED_REGIMEN_ID' : int,
-            'DATE_OF_FINAL_TREATMENT' : object,
-            'REGIMEN_MOD_DOSE_REDUCTION' : 'category',
-            'REGIMEN_MOD_TIME_DELAY' : 'category',
-            'REGIMEN_MOD_STOPPED_EARLY' : 'category',
-            'REGIMEN_OUTCOME_SUMMARY' : 'category',
-            'MERGED_PATIENT_ID' : int,
-            'MERGED_TUMOUR_ID' : int
-        },
-        'sact_patient' : {
-            'MERGED_PATIENT_ID' : int,
-            'LINK_NUMBER' : int
-        },
-        'sact_regimen' : {
-            'MERGED_REGIMEN_ID' : int,
-            'MERGED_TUMOUR_ID' : int,
-            'HEIGHT_AT_START_OF_REGIMEN' : float,
-            'WEIGHT_AT_START_OF_REGIMEN' : float,
-            'INTENT_OF_TREATMENT' : 'category',
-            'DATE_DECISION_TO_TREAT' : object,
-            'START_DATE_OF_REGIMEN' : object,
-            'MAPPED_REGIMEN' : object,
-            'CLINICAL_TRIAL' : 'category',
-            'CHEMO_RADIATION' : 'category',
-            'MERGED_PATIENT_ID' : int,
-            'BENCHMARK_GROUP' : 'category'
-        },
-        'sact_tumour' : {
-            'MERGED_TUMOUR_ID' : int,
-            'MERGED_PATIENT_ID' : int,
-            'CONSULTANT_SPECIALITY_CODE' : 'category',
-            'PRIMARY_DIAGNOSIS' : 'category',
-            'MORPHOLOGY_CLEAN' : 'category'
-        }
-    }
-    default_dates = {
-        'av_patient' : ['VITALSTATUSDATE'],
-        'av_tumour' : ['DIAGNOSISDATEBEST', 'DATE_FIRST_SURGERY'],
-        'sact_cycle' : ['START_DATE_OF_CYCLE'],
-        'sact_drug_detail' : ['ADMINISTRATION_DATE'],
-        'sact_outcome' : ['DATE_OF_FINAL_TREATMENT'],
-        'sact_patient' : [],
-        'sact_regimen' : ['DATE_DECISION_TO_TREAT', 'START_DATE_OF_REGIMEN'],
-        'sact_tumour' : []
-    }
+    With cache=True the typed table is also written to a parquet file next
+    to the csv the first time it is loaded, and read back from there
+    afterwards. The cache is rebuilt whenever the csv changes (size or
+    modification time) or a different dtype/parse_dates is asked for.
+    Caching is skipped if pyarrow is not installed. Use purge_cache
+    to delete the cache files.
+
+    To load part of a table set columns to a list of column names and/or
+    filters to a list of (column, op, value) conditions that rows must all
+    meet, e.g.
+
+        load_table('av_tumour',
+                   columns=['PATIENTID', 'SITE_ICD10_O2_3CHAR', 'DIAGNOSISDATEBEST'],
+                   filters=[('SITE_ICD10_O2_3CHAR', 'in', ['C50', 'C61']),
+                            ('DIAGNOSISDATEBEST', '>=', '2015-01-01')])
+
+    op is one of ==, !=, <, <=, >, >=, in, not in. Values for date columns
+    can be strings. Other columns are never parsed, and rows are filtered
+    chunk by chunk so the whole table is never in memory. If the table is
+    cached the filters also skip the parquet row groups that can't match.
+    Partial loads only read an existing cache; they don't create one.
+
+    profile='compact' shrinks the table in memory with compact_table.
+    With return_report=True also returns a dataframe with the type and
+    bytes used of each column before and after the profile.
+
+    The parse_dates columns are converted with parse_date_columns, and
+    bad_dates says what to do with placeholder and malformed dates. The
+    counts of missing, placeholder and malformed dates in each column (of
+    the rows read from the csv, before any filters) are kept in
+    table.attrs['bad_dates']; see bad_date_report.
+    """
+    if not profile in profiles:
+        raise ValueError("profile must be in " + str(profiles))
 
     # set to defaults
     table_name = table_name.lower()
@@ -165,33 +221,688 @@ def load_table(table_name,
         if parse_dates==None:
             parse_dates=default_dates[table_name]
 
-    read_path = os.path.join(folder, prefix + table_name.lower() + ".csv")
-    try:
-        if table_name == 'sact_regimen':
-            table = pd.read_csv(read_path, quotechar='"', dtype=dtype, parse_dates=parse_dates,encoding="ISO-8859-1")
-        else:
-            table = pd.read_csv(read_path, quotechar='"', dtype=dtype, parse_dates=parse_dates)
-    except FileNotFoundError:
+    read_path = table_path(table_name, folder, prefix)
+    if not os.path.exists(read_path):
         raise ValueError("The file " + read_path + " does not exist.")
+
+    cache_path = None
+    if cache and _parquet_available():
+        cache_path = _cache_path(read_path, dtype, parse_dates, bad_dates)
+
+    if columns is None and filters is None:
+        if cache_path is not None and os.path.exists(cache_path):
+            table = _read_cache(cache_path, dtype)
+        else:
+            table = _read_csv(read_path, table_name, dtype=dtype, parse_dates=parse_dates,
+                              bad_dates=bad_dates)
+            if cache_path is not None:
+                _write_cache(table, read_path, cache_path)
+    else:
+        filters = _check_filters(filters or [], parse_dates)
+        read_columns = None
+        if columns is not None:
+            columns = list(columns)
+            read_columns = columns + [column for column, op, value in filters
+                                      if column not in columns]
+        if cache_path is not None and os.path.exists(cache_path):
+            table = _read_cache(cache_path, dtype, columns=read_columns,
+                                filters=filters or None)
+            table = table[_filter_mask(table, filters)]
+        else:
+            if read_columns is not None and parse_dates:
+                parse_dates = [column for column in parse_dates if column in read_columns]
+            reader = _read_csv(read_path, table_name, dtype=dtype, parse_dates=parse_dates,
+                               bad_dates=bad_dates, usecols=read_columns, chunksize=1000000)
+            empty = _read_csv(read_path, table_name, dtype=dtype, parse_dates=parse_dates,
+                              bad_dates=bad_dates, usecols=read_columns, nrows=0)
+            table = concat_tables([chunk[_filter_mask(chunk, filters)] for chunk in reader],
+                                  empty=empty)
+        if columns is not None:
+            table = table[columns + [column + "_BAD" for column in columns
+                                     if column + "_BAD" in table.columns]]
+        table = table.reset_index(drop=True)
+        if 'bad_dates' in table.attrs:
+            table.attrs['bad_dates'] = {column: counts for column, counts
+                                        in table.attrs['bad_dates'].items()
+                                        if column in table.columns}
+    report = None
+    if profile == 'compact':
+        if return_report:
+            table, report = compact_table(table, return_report=True)
+        else:
+            table = compact_table(table)
+    elif return_report:
+        report = _memory_report(table, table)
     if add_descriptions:
         import descriptions
-        table = descriptions.add_descriptions(table, table_name)
+        if columns is None:
+            table = descriptions.add_descriptions(table, table_name)
+        else:
+            describe = [column for column in descriptions.zlookup_dicts[table_name]
+                        if column in columns]
+            histology = 'MORPH_ICD10_O2' in columns and 'BEHAVIOUR_ICD10_O2' in columns
+            table = descriptions.add_descriptions(table, table_name, columns=describe,
+                                                  histology=histology)
+    if return_report:
+        return table, report
+    return table
+
+def table_path(table_name, folder=default_folder, prefix=default_prefix):
+    """
+    Path of the csv file for a table (e.g. 'av_patient').
+    """
+    return os.path.join(folder, prefix + table_name.lower() + ".csv")
+
+def purge_cache(table_name=None, folder=default_folder, prefix=default_prefix):
+    """
+    Deletes the parquet cache files made by load_table, for one table
+    or (table_name=None) for all of them.
+
+    Returns the list of deleted paths.
+    """
+    if table_name is None:
+        names = table_names
+    else:
+        names = [table_name.lower()]
+    deleted = []
+    for name in names:
+        for path in _cache_files(table_path(name, folder, prefix)):
+            os.remove(path)
+            deleted.append(path)
+    return deleted
+
+def _read_csv(read_path, table_name, parse_dates=None, bad_dates='keep', **kwargs):
+    """
+    pd.read_csv with the options needed by the simulacrum csvs.
+
+    The parse_dates columns are read as text and then converted with
+    parse_date_columns. With a chunksize this returns a generator of chunks.
+    """
+    if table_name == 'sact_regimen':
+        kwargs["encoding"] = "ISO-8859-1"
+    date_columns = []
+    if isinstance(parse_dates, list) and (kwargs.get("dtype") is None or
+                                          isinstance(kwargs.get("dtype"), dict)):
+        date_columns = parse_dates
+        kwargs["dtype"] = dict(kwargs.get("dtype") or {})
+        kwargs["dtype"].update({column: object for column in date_columns})
+    elif parse_dates:
+        kwargs["parse_dates"] = parse_dates
+    try:
+        table = pd.read_csv(read_path, quotechar='"', **kwargs)
+    except FileNotFoundError:
+        raise ValueError("The file " + read_path + " does not exist.")
+    if len(date_columns) == 0:
+        return table
+    if kwargs.get("chunksize"):
+        return (parse_date_columns(chunk, date_columns, bad_dates) for chunk in table)
+    return parse_date_columns(table, date_columns, bad_dates)
+
+def parse_date_columns(table,
+                       columns,
+                       bad_dates='keep',
+                       sentinels=default_date_sentinels,
+                       return_report=False):
+    """
+    Converts columns of YYYY-MM-DD text in the table to dates.
+
+    Dates in sentinels (e.g. the 1900-01-01 placeholders in VITALSTATUSDATE)
+    and values that aren't dates at all are dealt with according to
+    bad_dates:
+
+    - 'keep': sentinel dates are kept, values that aren't dates become NaT
+    - 'nat': both become NaT
+    - 'flag': both become NaT and a COLUMN_BAD column marks them
+
+    Modifies the table and also returns it. The counts of missing, sentinel
+    and malformed values in each column are kept in table.attrs['bad_dates']
+    (see bad_date_report), and with return_report=True also returned as a
+    dataframe.
+    """
+    if not bad_dates in bad_date_options:
+        raise ValueError("bad_dates must be in " + str(bad_date_options))
+    sentinels = pd.to_datetime(list(sentinels))
+    report = pd.DataFrame(0, index=list(columns), columns=['missing', 'sentinel', 'malformed'])
+    for column in columns:
+        # there are only a few thousand distinct dates in a column, so
+        # parse each of those once and spread them back over the rows
+        codes, uniques = pd.factorize(table[column])
+        uniques = pd.Series(uniques, dtype=object)
+        unique_dates = pd.to_datetime(uniques, format='%Y-%m-%d', errors='coerce')
+        failed = unique_dates.isnull()
+        if failed.any():
+            # allow a time after the date, e.g. 2015-02-03 00:00:00
+            unique_dates[failed] = pd.to_datetime(uniques[failed].astype(str).str[:10],
+                                                  format='%Y-%m-%d', errors='coerce')
+        unique_malformed = unique_dates.isnull().values
+        unique_sentinel = unique_dates.isin(sentinels).values
+        if bad_dates != 'keep':
+            unique_dates[unique_sentinel] = pd.NaT
+        # missing values have code -1, which picks the appended NaT/False
+        table[column] = pd.DatetimeIndex(
+            np.append(unique_dates.values, np.datetime64('NaT'))[codes])
+        malformed = np.append(unique_malformed, False)[codes]
+        sentinel = np.append(unique_sentinel, False)[codes]
+        if bad_dates == 'flag':
+            table[column + "_BAD"] = sentinel | malformed
+        report.loc[column] = [(codes == -1).sum(), sentinel.sum(), malformed.sum()]
+    table.attrs['bad_dates'] = {column: {name: int(count) for name, count in counts.items()}
+                                for column, counts in report.to_dict('index').items()}
+    if return_report:
+        return table, report
     return table
 
+def bad_date_report(table):
+    """
+    Dataframe counting the missing, sentinel and malformed values in each
+    date column of a table loaded by load_table (see parse_date_columns).
+    Empty if the table has no counts, e.g. after merging it with another.
+    """
+    return pd.DataFrame.from_dict(table.attrs.get('bad_dates', {}), orient='index',
+                                  columns=['missing', 'sentinel', 'malformed'])
+
+def _parquet_available():
+    try:
+        import pyarrow
+    except ImportError:
+        return False
+    return True
+
+# bump when what is written to the cache changes (1: bad date counts in attrs)
+_cache_version = 1
+
+def _cache_key(read_path, dtype, parse_dates, bad_dates):
+    """
+    Hash of everything that determines the contents of a cached table:
+    the csv size and modification time, and the requested types.
+    """
+    stat = os.stat(read_path)
+    if isinstance(dtype, dict):
+        dtype = sorted((column, str(t)) for column, t in dtype.items())
+    else:
+        dtype = str(dtype)
+    key = repr((stat.st_size, stat.st_mtime_ns, dtype, parse_dates, bad_dates, _cache_version))
+    return hashlib.md5(key.encode()).hexdigest()[:16]
+
+def _cache_path(read_path, dtype, parse_dates, bad_dates='keep'):
+    return (os.path.splitext(read_path)[0] + "."
+            + _cache_key(read_path, dtype, parse_dates, bad_dates) + ".parquet")
+
+def _cache_files(read_path):
+    return glob.glob(glob.escape(os.path.splitext(read_path)[0]) + ".*.parquet")
+
+def _read_cache(cache_path, dtype, columns=None, filters=None):
+    table = pd.read_parquet(cache_path, columns=columns, filters=filters)
+    # parquet has no python object type, so string columns can come back
+    # as a string dtype
+    if isinstance(dtype, dict):
+        for column, column_type in dtype.items():
+            if (column_type is object and column in table.columns and
+                pd.api.types.is_string_dtype(table[column].dtype)):
+                table[column] = table[column].astype(object)
+    return table
+
+def _write_cache(table, read_path, cache_path):
+    """
+    Writes the table to cache_path, replacing any stale caches of the same
+    csv. A failed write (e.g. read-only data folder) just means no cache.
+    """
+    tmp_path = cache_path + ".tmp"
+    try:
+        for stale in _cache_files(read_path):
+            os.remove(stale)
+        # smallish row groups so filters can skip most of a table
+        table.to_parquet(tmp_path, index=False, row_group_size=250000)
+        os.replace(tmp_path, cache_path)
+    except (OSError, ValueError, TypeError):
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
 def all_tables(add_descriptions=False,
                folder=default_folder,
-               prefix=default_prefix):
+               prefix=default_prefix,
+               cache=True,
+               workers=1,
+               split_tables=default_split_tables,
+               profile='default',
+               report=False):
     """
     Loads all tables into dictionary with table names as keys.
 
     Option to add all available descriptions.
+
+    With workers > 1 the tables are loaded at the same time in a pool of
+    that many processes. The csvs of the tables in split_tables (the big
+    sact tables) are also cut into byte ranges which are parsed in
+    parallel and then joined back together (unless they are already cached).
+
+    profile='compact' shrinks each table in memory with compact_table.
+
+    Set report=True to print how long each table took, and with the compact
+    profile how much memory each table used before and after. The report is
+    also returned, after the tables, as a dataframe indexed by table name
+    with columns rows, seconds, bytes_before, bytes_after and bad_dates
+    (the number of placeholder and malformed dates, see bad_date_report).
     """
+    if not profile in profiles:
+        raise ValueError("profile must be in " + str(profiles))
+    timings = {}
+    memory = {}
     table_dict = {}
-    for table_name in table_names:
-        table_dict[table_name] = load_table(table_name,
-                                            dtype=None,
-                                            parse_dates=None,
-                                            add_descriptions=add_descriptions,
-                                            folder=folder,
-                                            prefix=prefix)
-    return table_dict
+    start = time.time()
+    if workers <= 1:
+        for table_name in table_names:
+            table_dict[table_name], timings[table_name], memory[table_name] = _timed_load_table(
+                table_name,
+                profile=profile,
+                report=report,
+                add_descriptions=add_descriptions,
+                folder=folder,
+                prefix=prefix,
+                cache=cache)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            part_futures, futures, submitted = {}, {}, {}
+            for table_name in table_names:
+                read_path = table_path(table_name, folder, prefix)
+                if (table_name in split_tables and
+                    not (cache and _cached(read_path, table_name))):
+                    submitted[table_name] = time.time()
+                    part_futures[table_name] = [
+                        executor.submit(_load_byte_range, read_path, table_name,
+                                        byte_start, byte_end)
+                        for byte_start, byte_end in _byte_ranges(read_path, workers)]
+            for table_name in table_names:
+                if table_name not in part_futures:
+                    futures[table_name] = executor.submit(_timed_load_table,
+                                                          table_name,
+                                                          profile=profile,
+                                                          report=report,
+                                                          add_descriptions=add_descriptions,
+                                                          folder=folder,
+                                                          prefix=prefix,
+                                                          cache=cache)
+            for table_name, table_futures in part_futures.items():
+                parts = [future.result() for future in table_futures]
+                table = concat_tables([part for part, seconds in parts])
+                if cache and _parquet_available():
+                    read_path = table_path(table_name, folder, prefix)
+                    _write_cache(table, read_path, _cache_path(
+                        read_path, default_dtypes[table_name], default_dates[table_name]))
+                if add_descriptions:
+                    import descriptions
+                    table = descriptions.add_descriptions(table, table_name)
+                table, memory[table_name] = _compact(table, profile, report)
+                table_dict[table_name] = table
+                # elapsed time, not the sum of the parts' times as they ran at once
+                timings[table_name] = time.time() - submitted[table_name]
+            for table_name, future in futures.items():
+                table_dict[table_name], timings[table_name], memory[table_name] = future.result()
+    table_dict = {table_name: table_dict[table_name] for table_name in table_names}
+    if not report:
+        return table_dict
+    memory_report = pd.DataFrame({
+        'rows': [len(table_dict[table_name]) for table_name in table_names],
+        'seconds': [timings[table_name] for table_name in table_names],
+        'bytes_before': [memory[table_name][0] for table_name in table_names],
+        'bytes_after': [memory[table_name][1] for table_name in table_names],
+        'bad_dates': [int(bad_date_report(table_dict[table_name])[['sentinel', 'malformed']].values.sum())
+                      for table_name in table_names]},
+        index=pd.Index(table_names, name='table'))
+    memory_report = memory_report.sort_values('seconds', ascending=False, kind='mergesort')
+    print("{:<20}{:>12}{:>12}{:>12}{:>12}".format("table", "rows", "seconds",
+                                                  "MB before", "MB after"))
+    for row in memory_report.itertuples():
+        print("{:<20}{:>12}{:>12.1f}{:>12.1f}{:>12.1f}".format(
+            row.Index, row.rows, row.seconds, row.bytes_before / 1e6, row.bytes_after / 1e6))
+    print("{:<20}{:>12}{:>12.1f}".format("wall time", "", time.time() - start))
+    return table_dict, memory_report
+
+def compact_table(table, max_unique_fraction=0.5, return_report=False):
+    """
+    Returns a copy of the table using less memory:
+
+    - integer columns (the IDs, link numbers, ...) are downcast to the
+      smallest integer type that holds them, unsigned if none are negative
+    - text columns with at most max_unique_fraction unique values
+      (e.g. DEATHCAUSECODE_*, MAPPED_REGIMEN) become categorical
+    - dates held as python objects become datetime64
+
+    With return_report=True also returns a dataframe with the type and
+    bytes used of each column before and after.
+    """
+    compact = table.copy()
+    for column in compact.columns:
+        values = compact[column]
+        if pd.api.types.is_integer_dtype(values.dtype):
+            if len(values) > 0 and values.min() >= 0:
+                compact[column] = pd.to_numeric(values, downcast='unsigned')
+            else:
+                compact[column] = pd.to_numeric(values, downcast='integer')
+        elif values.dtype == object:
+            kind = pd.api.types.infer_dtype(values, skipna=True)
+            if kind in ['datetime', 'datetime64', 'date']:
+                compact[column] = pd.to_datetime(values)
+            elif (kind == 'string' and
+                  values.nunique() <= max_unique_fraction * len(values)):
+                compact[column] = values.astype('category')
+    if not return_report:
+        return compact
+    return compact, _memory_report(table, compact)
+
+def _memory_report(before, after):
+    """
+    Dataframe with the type and bytes used of each column of a table
+    before and after changing its types.
+    """
+    return pd.DataFrame({
+        'dtype_before': before.dtypes.astype(str),
+        'dtype_after': after.dtypes.astype(str),
+        'bytes_before': before.memory_usage(index=False, deep=True),
+        'bytes_after': after.memory_usage(index=False, deep=True)})
+
+def memory_usage(table):
+    """
+    Total bytes used by a table, including the python strings it holds.
+    """
+    return int(table.memory_usage(index=True, deep=True).sum())
+
+def concat_tables(tables, empty=None):
+    """
+    Concatenates parts of a table (e.g. chunks), merging the categories
+    of categorical columns so they stay categorical.
+
+    If there are no parts returns empty, a table with no rows and the
+    expected columns and types (an empty dataframe if None).
+    """
+    tables = list(tables)
+    if len(tables) == 0:
+        return pd.DataFrame() if empty is None else empty.iloc[:0]
+    bad_dates = _sum_bad_dates(tables)
+    for column in tables[0].columns:
+        if isinstance(tables[0][column].dtype, pd.CategoricalDtype):
+            categories = set()
+            for table in tables:
+                categories.update(table[column].cat.categories)
+            categories = sorted(categories)
+            for table in tables:
+                table[column] = table[column].cat.set_categories(categories)
+    table = pd.concat(tables, ignore_index=True)
+    if bad_dates is not None:
+        table.attrs['bad_dates'] = bad_dates
+    return table
+
+def _sum_bad_dates(tables):
+    """
+    The bad date counts of parts of a table added together, None if any
+    part has none.
+    """
+    if not all(['bad_dates' in table.attrs for table in tables]):
+        return None
+    total = {}
+    for table in tables:
+        for column, counts in table.attrs['bad_dates'].items():
+            column_total = total.setdefault(column, dict.fromkeys(counts, 0))
+            for name, count in counts.items():
+                column_total[name] += count
+    return total
+
+_filter_ops = ['==', '!=', '<', '<=', '>', '>=', 'in', 'not in']
+
+def _check_filters(filters, parse_dates):
+    """
+    Checks the filters passed to load_table and turns the values for date
+    columns into timestamps.
+    """
+    checked = []
+    for column, op, value in filters:
+        if op == '=':
+            op = '=='
+        if not op in _filter_ops:
+            raise ValueError("filter op must be in " + str(_filter_ops))
+        if parse_dates and column in parse_dates:
+            if op in ['in', 'not in']:
+                value = [pd.Timestamp(v) for v in value]
+            else:
+                value = pd.Timestamp(value)
+        checked.append((column, op, value))
+    return checked
+
+def _filter_mask(table, filters):
+    """
+    Boolean series of the rows of table meeting all the filters.
+    Missing values never meet a filter.
+    """
+    mask = pd.Series(True, index=table.index)
+    for column, op, value in filters:
+        values = table[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            if op in ['in', 'not in', '==', '!=']:
+                categories = values.cat.categories
+                if op in ['in', 'not in']:
+                    keep = categories.isin(value)
+                else:
+                    keep = categories == value
+                if op in ['not in', '!=']:
+                    keep = ~keep
+                # missing values have code -1, which picks the appended False
+                mask &= np.append(keep, False)[values.cat.codes.values]
+                continue
+            values = values.astype(object)
+        if op == 'in':
+            mask &= values.isin(value)
+        elif op == 'not in':
+            mask &= ~values.isin(value) & values.notnull()
+        elif op == '==':
+            mask &= values == value
+        elif op == '!=':
+            mask &= (values != value) & values.notnull()
+        elif op == '<':
+            mask &= values < value
+        elif op == '<=':
+            mask &= values <= value
+        elif op == '>':
+            mask &= values > value
+        elif op == '>=':
+            mask &= values >= value
+    return mask
+
+def _timed_load_table(table_name, profile='default', report=False, **kwargs):
+    start = time.time()
+    table = load_table(table_name, **kwargs)
+    table, memory = _compact(table, profile, report)
+    return table, time.time() - start, memory
+
+def _compact(table, profile, report):
+    """
+    Applies the profile to a table loaded with the default types, returning
+    it with its (before, after) memory use in bytes (if report is True).
+    """
+    before = after = memory_usage(table) if report else 0
+    if profile == 'compact':
+        table = compact_table(table)
+        if report:
+            after = memory_usage(table)
+    return table, (before, after)
+
+def _cached(read_path, table_name):
+    return (_parquet_available() and os.path.exists(_cache_path(
+        read_path, default_dtypes[table_name], default_dates[table_name])))
+
+def _byte_ranges(read_path, n):
+    """
+    Splits a csv (after its header line) into about n byte ranges that
+    start and end on line breaks. Assumes no quoted field contains a
+    line break, which holds for the simulacrum csvs.
+    """
+    size = os.path.getsize(read_path)
+    with open(read_path, "rb") as read_file:
+        read_file.readline()
+        starts = [read_file.tell()]
+        for i in range(1, n):
+            read_file.seek(max(starts[-1], starts[0] + (size - starts[0]) * i // n))
+            read_file.readline()
+            if read_file.tell() >= size:
+                break
+            if read_file.tell() > starts[-1]:
+                starts.append(read_file.tell())
+    return list(zip(starts, starts[1:] + [size]))
+
+def _load_byte_range(read_path, table_name, byte_start, byte_end):
+    """
+    Parses the rows of a csv between two byte offsets, typed as load_table
+    would type them.
+    """
+    start = time.time()
+    with open(read_path, "rb") as read_file:
+        header = read_file.readline()
+        read_file.seek(byte_start)
+        data = read_file.read(byte_end - byte_start)
+    table = _read_csv(io.BytesIO(header + data), table_name,
+                      dtype=default_dtypes[table_name],
+                      parse_dates=default_dates[table_name])
+    return table, time.time() - start
+
+def iter_table(table_name,
+               chunksize=1000000,
+               columns=None,
+               dtype=None,
+               parse_dates=None,
+               categories=None,
+               folder=default_folder,
+               prefix=default_prefix):
+    """
+    Reads a table in chunks of chunksize rows, yielding each chunk as a
+    dataframe typed like load_table would type it. Use this for tables too
+    big to hold in memory (e.g. sact_drug_detail, sact_cycle).
+
+    Categorical columns get the same categories in every chunk, so chunks
+    can be concatenated or compared without recoding. The categories are
+    found with a first pass over just those columns (see table_categories),
+    or can be passed in as a dictionary of column name to categories.
+
+    Set columns to a list of column names to read only those.
+    """
+    table_name = table_name.lower()
+    if table_name in table_names:
+        if dtype==None:
+            dtype=default_dtypes[table_name]
+        if parse_dates==None:
+            parse_dates=default_dates[table_name]
+    dtype = dict(dtype or {})
+    parse_dates = list(parse_dates or [])
+    if columns is not None:
+        dtype = {column: t for column, t in dtype.items() if column in columns}
+        parse_dates = [column for column in parse_dates if column in columns]
+
+    category_columns = [column for column, t in dtype.items() if t == 'category']
+    if categories is None:
+        categories = table_categories(table_name, category_columns, chunksize,
+                                      folder=folder, prefix=prefix)
+    for column in category_columns:
+        dtype[column] = object
+
+    read_path = table_path(table_name, folder, prefix)
+    reader = _read_csv(read_path, table_name, dtype=dtype, parse_dates=parse_dates,
+                       usecols=columns, chunksize=chunksize)
+    for chunk in reader:
+        for column in category_columns:
+            chunk[column] = pd.Categorical(chunk[column],
+                                           categories=categories[column])
+        yield chunk
+
+def table_categories(table_name,
+                     columns=None,
+                     chunksize=1000000,
+                     folder=default_folder,
+                     prefix=default_prefix):
+    """
+    Returns a dictionary of column name to the sorted unique values in
+    that column, reading the table in chunks.
+
+    columns defaults to the categorical columns of the table.
+    """
+    table_name = table_name.lower()
+    if columns is None:
+        columns = [column for column, t in default_dtypes.get(table_name, {}).items()
+                   if t == 'category']
+    if len(columns) == 0:
+        return {}
+    uniques = {column: set() for column in columns}
+    read_path = table_path(table_name, folder, prefix)
+    reader = _read_csv(read_path, table_name, dtype=object, usecols=columns,
+                       chunksize=chunksize)
+    for chunk in reader:
+        for column in columns:
+            uniques[column].update(chunk[column].dropna().unique())
+    return {column: sorted(values) for column, values in uniques.items()}
+
+def fold_table(table_name, func, combine, chunksize=1000000, **kwargs):
+    """
+    Calls func on every chunk of the table (see iter_table) and folds the
+    results together with combine(result_so_far, chunk_result).
+
+    Returns the final result (None for an empty table). Extra keyword
+    arguments are passed to iter_table.
+    """
+    result = None
+    for chunk in iter_table(table_name, chunksize=chunksize, **kwargs):
+        chunk_result = func(chunk)
+        if result is None:
+            result = chunk_result
+        else:
+            result = combine(result, chunk_result)
+    return result
+
+_fold_aggregations = {
+    'size': 'sum',
+    'count': 'sum',
+    'sum': 'sum',
+    'min': 'min',
+    'max': 'max'
+}
+
+def aggregate_table(table_name, by, aggregations, chunksize=1000000, **kwargs):
+    """
+    Group by aggregation over a table that never holds the whole table in
+    memory, e.g.
+
+        aggregate_table('sact_drug_detail', 'MERGED_REGIMEN_ID',
+                        {'ADMINISTRATION_DATE': ['min', 'max'],
+                         'ACTUAL_DOSE_PER_ADMINISTRATION': ['count', 'sum']})
+
+    aggregations maps column names to a list of 'size', 'count', 'sum',
+    'min' and 'max' (the aggregations that can be combined chunk by chunk).
+
+    Returns a dataframe indexed by the by column(s) with a column for each
+    aggregation, named like COLUMN_agg.
+    """
+    if isinstance(by, str):
+        by = [by]
+    for column, aggs in aggregations.items():
+        if not all([agg in _fold_aggregations for agg in aggs]):
+            raise ValueError("aggregations must be in " + str(list(_fold_aggregations.keys())))
+    combine_aggs = {column + "_" + agg: _fold_aggregations[agg]
+                    for column, aggs in aggregations.items() for agg in aggs}
+    columns = list(by) + [column for column in aggregations if column not in by]
+
+    def func(chunk):
+        grouped = chunk.groupby(by, observed=True, sort=False)
+        result = pd.DataFrame(index=grouped.size().index)
+        for column, aggs in aggregations.items():
+            for agg in aggs:
+                if agg == 'size':
+                    result[column + "_size"] = grouped.size()
+                else:
+                    result[column + "_" + agg] = grouped[column].agg(agg)
+        return result
+
+    def combine(result, chunk_result):
+        both = pd.concat([result, chunk_result])
+        return both.groupby(level=list(range(len(by))), sort=False).agg(combine_aggs)
+
+    result = fold_table(table_name, func, combine, chunksize=chunksize,
+                        columns=columns, **kwargs)
+    if result is None:
+        return pd.DataFrame(columns=list(combine_aggs.keys()))
+    return result.sort_index()
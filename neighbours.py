@@ -0,0 +1,208 @@
+"""
+module for finding patients with similar pathways
+Version 1.1.0
+for use with simulacrum_release_v1.1.0
+"""
+
+import os
+import numpy as np
+import pandas as pd
+
+array_names = ['vectors', 'ids', 'planes', 'codes', 'orders']
+
+
+class NeighbourIndex(object):
+
+    """
+    Approximate nearest-neighbour index of pathway vectors (e.g. summed
+    word2vec event vectors, see sequences.end_coordinates, or the SVD
+    coordinates of TF-IDF features, see features.reduce_dimensions) by
+    cosine similarity.
+
+    Each of n_tables random-hyperplane hashes puts every vector in a bucket
+    given by which side of n_bits random hyperplanes it is on. Vectors that
+    share a bucket with the query in any table are candidates, and the
+    candidates are ranked by their exact similarity, so a query only looks
+    at a few buckets rather than every patient.
+
+    - vectors: the unit-length vectors, a row per patient
+    - ids: the PATIENTID of each row
+    - planes: normals of the hyperplanes, n_tables x dimensions x n_bits
+    - codes, orders: for each table, the sorted bucket codes and the rows
+      in that order
+    """
+
+    def __init__(self, vectors, ids, planes, codes, orders):
+        self.vectors = vectors
+        self.ids = ids
+        self.planes = planes
+        self.codes = codes
+        self.orders = orders
+        self._id_order = None
+        self._sorted_ids = None
+
+    @classmethod
+    def build(cls, vectors, ids, n_tables=8, n_bits=None, seed=1):
+        """
+        Builds the index of vectors (a row per patient) with the PATIENTIDs
+        ids. n_bits defaults to about log2(number of patients/64) so
+        buckets hold around 64 patients.
+        """
+        vectors = _unit_rows(np.asarray(vectors, dtype=np.float32))
+        if n_bits is None:
+            n_bits = int(np.clip(np.round(np.log2(max(len(vectors), 1)/64.0)), 1, 62))
+        rng = np.random.RandomState(seed)
+        planes = rng.standard_normal((n_tables, vectors.shape[1], n_bits)).astype(np.float32)
+        codes = np.empty((n_tables, len(vectors)), dtype=np.int64)
+        orders = np.empty((n_tables, len(vectors)), dtype=np.int64)
+        for table in range(n_tables):
+            table_codes = _bucket_codes(vectors, planes[table], n_bits)[:, 0]
+            orders[table] = np.argsort(table_codes, kind='mergesort')
+            codes[table] = table_codes[orders[table]]
+        return cls(vectors, np.asarray(ids), planes, codes, orders)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def query(self, patient_id, k=10):
+        """
+        The k patients with pathways most similar to that of patient_id, as
+        a dataframe with columns PATIENTID and similarity.
+        """
+        result = self.query_many([patient_id], k)
+        return result[['PATIENTID', 'similarity']].reset_index(drop=True)
+
+    def query_many(self, patient_ids, k=10, batch_size=1000):
+        """
+        The k most similar patients to each of patient_ids, as a dataframe
+        with columns query (the PATIENTID asked about), rank, PATIENTID and
+        similarity. Each patient is left out of their own neighbours.
+        """
+        rows = self.rows(patient_ids)
+        if (rows < 0).any():
+            raise ValueError("Unknown PATIENTID " + str(np.atleast_1d(patient_ids)[rows < 0][0]))
+        query, neighbour, similarity, rank = self._query_batches(self.vectors, rows, self.ids[rows], k, batch_size)
+        return pd.DataFrame({'query': self.ids[rows][query],
+                             'rank': rank,
+                             'PATIENTID': self.ids[neighbour],
+                             'similarity': similarity})
+
+    def query_vectors(self, vectors, k=10, batch_size=1000):
+        """
+        The k patients most similar to each of vectors (new pathways not in
+        the index), with columns query (row of vectors), rank, PATIENTID and
+        similarity.
+        """
+        vectors = _unit_rows(np.asarray(vectors, dtype=np.float32).reshape(-1, self.vectors.shape[1]))
+        rows = np.arange(len(vectors))
+        query, neighbour, similarity, rank = self._query_batches(vectors, rows, None, k, batch_size)
+        return pd.DataFrame({'query': query,
+                             'rank': rank,
+                             'PATIENTID': self.ids[neighbour],
+                             'similarity': similarity})
+
+    def rows(self, patient_ids):
+        """
+        Row in the index of each of patient_ids (the first, if a patient has
+        several), -1 for those not in it.
+        """
+        if self._id_order is None:
+            self._id_order = np.argsort(self.ids, kind='mergesort')
+            self._sorted_ids = self.ids[self._id_order]
+        order, sorted_ids = self._id_order, self._sorted_ids
+        patient_ids = np.atleast_1d(patient_ids)
+        positions = np.searchsorted(sorted_ids, patient_ids)
+        positions[positions == len(sorted_ids)] = 0
+        found = sorted_ids[positions] == patient_ids if len(sorted_ids) else np.zeros(len(patient_ids), dtype=bool)
+        return np.where(found, order[positions], -1)
+
+    def save(self, folder):
+        """
+        Saves the index to a folder as .npy arrays.
+        """
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        for name in array_names:
+            np.save(os.path.join(folder, name + ".npy"), getattr(self, name))
+
+    @classmethod
+    def load(cls, folder, mmap_mode='r'):
+        """
+        Loads an index saved with save, memory-mapped by default.
+        """
+        arrays = {}
+        for name in array_names:
+            read_path = os.path.join(folder, name + ".npy")
+            if not os.path.exists(read_path):
+                raise ValueError("The file " + read_path + " does not exist.")
+            arrays[name] = np.load(read_path, mmap_mode=mmap_mode, allow_pickle=name == 'ids')
+        return cls(**arrays)
+
+    def _query_batches(self, vectors, rows, exclude, k, batch_size):
+        """
+        _query of vectors[rows], batch_size at a time, with query numbered
+        by position in rows.
+        """
+        results = [(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                    np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int64))]
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            batch_exclude = None if exclude is None else exclude[start:start + batch_size]
+            query, neighbour, similarity, rank = self._query(np.asarray(vectors[batch]), batch_exclude, k)
+            results.append((query + start, neighbour, similarity, rank))
+        return [np.concatenate(arrays) for arrays in zip(*results)]
+
+    def _query(self, vectors, exclude, k):
+        """
+        (query, neighbour, similarity, rank) arrays for a batch of query
+        vectors, leaving out every row of patient exclude[i] from the
+        neighbours of query i (nothing if exclude is None).
+        """
+        queries, candidates = [], []
+        n_tables, dimensions, n_bits = self.planes.shape
+        # bucket codes of the queries in every table from one product
+        all_codes = _bucket_codes(vectors, np.asarray(self.planes).transpose(1, 0, 2).reshape(dimensions, -1), n_bits)
+        for table in range(n_tables):
+            query_codes = all_codes[:, table]
+            starts = np.searchsorted(self.codes[table], query_codes, side='left')
+            ends = np.searchsorted(self.codes[table], query_codes, side='right')
+            counts = ends - starts
+            total = np.cumsum(counts)
+            # every (query, row in the same bucket) pair
+            index = np.repeat(starts - (total - counts), counts) + np.arange(total[-1] if len(total) else 0)
+            queries.append(np.repeat(np.arange(len(vectors)), counts))
+            candidates.append(self.orders[table][index])
+        queries = np.concatenate(queries)
+        candidates = np.concatenate(candidates)
+        if exclude is None:
+            keep = np.ones(len(candidates), dtype=bool)
+        else:
+            keep = self.ids[candidates] != exclude[queries]
+        # each (query, candidate) pair once, found in several tables or not
+        pairs = np.sort(queries[keep]*len(self.ids) + candidates[keep])
+        pairs = pairs[np.append(True, pairs[1:] != pairs[:-1])]
+        queries, candidates = pairs//len(self.ids), pairs % len(self.ids)
+        similarity = np.einsum('ij,ij->i', vectors[queries], np.asarray(self.vectors[candidates]))
+        # queries are in increasing order already, so this sorts by similarity within each query
+        order = np.argsort(queries*4.0 + (1 - similarity), kind='stable')
+        queries, candidates, similarity = queries[order], candidates[order], similarity[order]
+        # rank within each query
+        first = np.searchsorted(queries, np.arange(len(vectors)))
+        rank = np.arange(len(queries)) - first[queries] + 1
+        top = rank <= k
+        return queries[top], candidates[top], similarity[top], rank[top]
+
+
+def _unit_rows(vectors):
+    lengths = np.linalg.norm(vectors, axis=1, keepdims=True)
+    lengths[lengths == 0] = 1
+    return vectors/lengths
+
+def _bucket_codes(vectors, planes, n_bits):
+    """
+    Buckets of each vector: the bits of which side of each plane it is on,
+    n_bits planes to a bucket code. Returns an array with a row per vector
+    and a column per group of n_bits planes.
+    """
+    bits = (np.asarray(vectors).dot(planes) > 0).reshape(len(vectors), -1, n_bits)
+    return bits.dot(np.left_shift(1, np.arange(n_bits, dtype=np.int64)))
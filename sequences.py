@@ -0,0 +1,259 @@
+"""
+module for storing patient pathways as integer-coded event sequences
+Version 1.1.0
+for use with simulacrum_release_v1.1.0
+"""
+
+import os
+import itertools
+import numpy as np
+import pandas as pd
+
+array_names = ['tokens', 'days', 'offsets', 'vocabulary', 'vocabulary_types']
+
+
+class SequenceStore(object):
+
+    """
+    The event sequences of many patients in a few flat arrays:
+
+    - vocabulary: the distinct events (e.g. 'DRUG_GROUP CAPECITABINE')
+      and vocabulary_types their event types (e.g. 'DRUG_GROUP')
+    - tokens: int32 position in the vocabulary of every event, one
+      sequence after another
+    - days: days since the first event of the sequence, for every event
+    - offsets: sequence i is tokens[offsets[i]:offsets[i+1]]
+    - rows: dataframe with one row per sequence (PATIENTID,
+      PRIMARY_DIAGNOSIS and any other per-patient columns)
+
+    Build one from the output of slap.Sequenceofevents with from_events.
+    """
+
+    def __init__(self, tokens, days, offsets, vocabulary, vocabulary_types, rows):
+        self.tokens = tokens
+        self.days = days
+        self.offsets = offsets
+        self.vocabulary = vocabulary
+        self.vocabulary_types = vocabulary_types
+        self.rows = rows.reset_index(drop=True)
+
+    @classmethod
+    def from_events(cls, df_pathway_events, by=['PATIENTID', 'PRIMARY_DIAGNOSIS']):
+        """
+        Builds the store from a dataframe like the output of
+        slap.Sequenceofevents, with one sequence per distinct value of the
+        by columns. Events keep their order within a sequence.
+        """
+        by_codes = []
+        by_uniques = []
+        for column in by:
+            codes, uniques = pd.factorize(df_pathway_events[column], sort=True)
+            by_codes.append(codes)
+            by_uniques.append(uniques)
+        # stable sort by the by columns (np.lexsort sorts by the last key first)
+        order = np.lexsort([np.arange(len(df_pathway_events))] + by_codes[::-1])
+        sorted_codes = [codes[order] for codes in by_codes]
+
+        new_sequence = np.zeros(len(order), dtype=bool)
+        new_sequence[:1] = True
+        for codes in sorted_codes:
+            new_sequence[1:] |= codes[1:] != codes[:-1]
+        starts = np.flatnonzero(new_sequence)
+        offsets = np.append(starts, len(order)).astype(np.int64)
+
+        rows = pd.DataFrame()
+        for column, codes, uniques in zip(by, sorted_codes, by_uniques):
+            codes = codes[starts]
+            if (codes < 0).any():
+                # missing values have code -1, which picks the appended NaN
+                uniques = np.append(np.asarray(uniques, dtype=object), np.nan)
+            rows[column] = np.asarray(uniques)[codes]
+
+        event_codes, vocabulary = pd.factorize(df_pathway_events['event'], sort=True)
+        tokens = event_codes[order].astype(np.int32)
+        vocabulary_types = (df_pathway_events['event_type'].iloc[
+            np.unique(event_codes, return_index=True)[1]]).values
+        days = df_pathway_events['days'].values[order].astype(np.int32)
+        return cls(tokens, days, offsets,
+                   np.asarray(vocabulary, dtype=str),
+                   np.asarray(vocabulary_types, dtype=str),
+                   rows)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def lengths(self):
+        """
+        Number of events in each sequence.
+        """
+        return np.diff(self.offsets)
+
+    def sequence(self, i):
+        """
+        The events of sequence i, as a list of strings.
+        """
+        return self.vocabulary[self.tokens[self.offsets[i]:self.offsets[i+1]]].tolist()
+
+    def sequence_days(self, i):
+        """
+        The days of the events of sequence i.
+        """
+        return self.days[self.offsets[i]:self.offsets[i+1]].tolist()
+
+    def take(self, positions):
+        """
+        New store with just the sequences at positions (integer array or
+        boolean mask), in that order.
+        """
+        positions = np.arange(len(self))[positions]
+        starts = self.offsets[:-1][positions]
+        lengths = self.lengths()[positions]
+        offsets = np.append(0, np.cumsum(lengths)).astype(np.int64)
+        # index of every event to keep: each sequence's start, counting up
+        event_index = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return SequenceStore(self.tokens[event_index],
+                             self.days[event_index],
+                             offsets,
+                             self.vocabulary,
+                             self.vocabulary_types,
+                             self.rows.iloc[positions])
+
+    def select(self, patient_ids=None, diagnoses=None):
+        """
+        New store with the sequences of the given patients and/or
+        primary diagnoses.
+        """
+        mask = np.ones(len(self), dtype=bool)
+        if patient_ids is not None:
+            mask &= self.rows['PATIENTID'].isin(patient_ids).values
+        if diagnoses is not None:
+            mask &= self.rows['PRIMARY_DIAGNOSIS'].isin(diagnoses).values
+        return self.take(mask)
+
+    def iter_rows(self, chunksize=100000):
+        """
+        Iterates over rows in chunks of chunksize sequences. The index of
+        each chunk is the sequence position, for use with take.
+        """
+        for start in range(0, len(self), chunksize):
+            yield self.rows.iloc[start:start + chunksize]
+
+    def add_patient_column(self, name, values):
+        """
+        Adds a per-patient column to rows (e.g. NEWVITALSTATUS_DESC) from a
+        series indexed by PATIENTID.
+        """
+        self.rows[name] = values.reindex(self.rows['PATIENTID']).values
+
+    def to_frame(self):
+        """
+        Dataframe with the columns of rows plus 'sequence' and 'sequence_days'
+        lists, the format the slap plotting functions take.
+        """
+        df = self.rows.copy()
+        events = self.vocabulary[self.tokens]
+        df['sequence'] = [events[start:end].tolist() for start, end
+                          in zip(self.offsets[:-1], self.offsets[1:])]
+        df['sequence_days'] = [self.days[start:end].tolist() for start, end
+                               in zip(self.offsets[:-1], self.offsets[1:])]
+        return df
+
+    def save(self, folder):
+        """
+        Saves the store to a folder as .npy arrays and a pickle of rows.
+        """
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        for name in array_names:
+            np.save(os.path.join(folder, name + ".npy"), getattr(self, name))
+        self.rows.to_pickle(os.path.join(folder, "rows.pkl"))
+
+    @classmethod
+    def load(cls, folder, mmap_mode='r'):
+        """
+        Loads a store saved with save. By default the arrays are memory-mapped
+        so only the parts used are read from disk.
+        """
+        arrays = {}
+        for name in array_names:
+            read_path = os.path.join(folder, name + ".npy")
+            if not os.path.exists(read_path):
+                raise ValueError("The file " + read_path + " does not exist.")
+            arrays[name] = np.load(read_path, mmap_mode=mmap_mode)
+        rows = pd.read_pickle(os.path.join(folder, "rows.pkl"))
+        return cls(rows=rows, **arrays)
+
+
+def rows_and_sequences(sequences):
+    """
+    Splits a SequenceStore, or a dataframe with a 'sequence' column of event
+    lists, into its per-sequence rows and the sequences themselves.
+    """
+    if isinstance(sequences, SequenceStore):
+        return sequences.rows, sequences
+    return sequences.reset_index(drop=True), sequences['sequence']
+
+
+def flatten(sequences):
+    """
+    tokens, offsets and vocabulary (as in SequenceStore) of a SequenceStore
+    or of a list or series of event lists.
+    """
+    if isinstance(sequences, SequenceStore):
+        return sequences.tokens, sequences.offsets, sequences.vocabulary
+    sequences = list(sequences)
+    lengths = np.array([len(sequence) for sequence in sequences], dtype=np.int64)
+    offsets = np.append(0, np.cumsum(lengths)).astype(np.int64)
+    events = pd.Series(list(itertools.chain.from_iterable(sequences)), dtype=object)
+    tokens, vocabulary = pd.factorize(events)
+    return tokens.astype(np.int32), offsets, np.asarray(vocabulary, dtype=object)
+
+
+def embedding_matrix(vocabulary, mapping):
+    """
+    Array with the vector of each vocabulary event in mapping (e.g. map2D)
+    as its rows.
+    """
+    return np.array([np.asarray(mapping[event], dtype=float) for event in vocabulary])
+
+
+def end_coordinates(sequences, mapping):
+    """
+    Sum of the vectors of the events of each sequence, as an array with
+    a row per sequence. The sums are done for all sequences at once.
+    """
+    tokens, offsets, vocabulary = flatten(sequences)
+    dimensions = len(next(iter(mapping.values())))
+    ends = np.zeros((len(offsets) - 1, dimensions))
+    if len(tokens) == 0:
+        return ends
+    vectors = embedding_matrix(vocabulary, mapping)[tokens]
+    nonempty = offsets[:-1] < offsets[1:]
+    ends[nonempty] = np.add.reduceat(vectors, offsets[:-1][nonempty], axis=0)
+    return ends
+
+
+def pathway_coordinates(sequences, mapping):
+    """
+    Cumulative sum of the event vectors along each sequence.
+
+    Returns an array with a row per event and the offsets, so the
+    pathway of sequence i is coordinates[offsets[i]:offsets[i+1]].
+    """
+    tokens, offsets, vocabulary = flatten(sequences)
+    if len(tokens) == 0:
+        return np.zeros((0, len(next(iter(mapping.values()))))), offsets
+    vectors = embedding_matrix(vocabulary, mapping)[tokens]
+    totals = np.cumsum(vectors, axis=0)
+    # take off the running total from before each sequence started
+    before = np.vstack([np.zeros((1, vectors.shape[1])), totals])[offsets[:-1]]
+    coordinates = totals - np.repeat(before, np.diff(offsets), axis=0)
+    return coordinates, offsets
+
+
+def polar_coordinates(coordinates):
+    """
+    (r, theta) of an array of 2D coordinates.
+    """
+    x, y = coordinates[:, 0], coordinates[:, 1]
+    return np.hypot(x, y), np.arctan2(y, x)
@@ -3,6 +3,9 @@ SimuLacrum Analysis Package (SLAP)
 This module contains functions used by the UCL simulacrum team to analyse the
 simulacrum cancer data set.
 """
+import os
+import hashlib
+import collections
 import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
@@ -11,6 +14,7 @@ import plotly.graph_objs as go
 from plotly import tools
 import load
 import descriptions
+import sequences
 import random
 
 # Layout variables for plots
@@ -43,7 +47,73 @@ def frequency_plot_layout(search_var):
                      yaxis=y_axis)
 
 
-def stacked_barplot(df, col1, col2, tickmode='auto'):
+# Crosstabs computed so far, keyed on (table key, col1, col2)
+crosstab_cache = collections.OrderedDict()
+crosstab_cache_size = 64
+
+
+def crosstab(df, col1, col2, table_key=None, folder=None):
+    """
+    Number of rows of df with each pair of col2 and col1 values, as a
+    dataframe with the col2 values as index and the col1 values as columns
+    (NaN where a pair does not occur).
+
+    Given a table_key, crosstabs are kept in memory (up to
+    crosstab_cache_size of them) so plotting the same pair of columns again
+    is instant.
+
+    table_key: string identifying df and its version, e.g. the table name and
+               release. If None the crosstab is computed and not cached, as
+               telling whether df has changed would cost as much as the crosstab.
+    folder: if given (with a table_key), crosstabs are also saved to and read
+            from this folder, so they are reused across sessions
+    """
+    if table_key is None:
+        return _crosstab(df[col1], df[col2])
+    key = (table_key, col1, col2)
+    table = crosstab_cache.get(key)
+    if table is None:
+        cache_path = None
+        if folder is not None:
+            cache_path = os.path.join(folder, "crosstab." + hashlib.md5(repr(key).encode()).hexdigest()[:16] + ".pkl")
+        if cache_path is not None and os.path.exists(cache_path):
+            table = pd.read_pickle(cache_path)
+        else:
+            table = _crosstab(df[col1], df[col2])
+            if cache_path is not None:
+                if not os.path.exists(folder):
+                    os.makedirs(folder)
+                table.to_pickle(cache_path)
+        crosstab_cache[key] = table
+        while len(crosstab_cache) > crosstab_cache_size:
+            crosstab_cache.popitem(last=False)
+    crosstab_cache.move_to_end(key)
+    return table
+
+def clear_crosstab_cache():
+    """
+    Forget all the crosstabs computed so far (files saved to a folder are kept).
+    """
+    crosstab_cache.clear()
+
+def _crosstab(values1, values2):
+    codes1, uniques1 = pd.factorize(values1, sort=True)
+    codes2, uniques2 = pd.factorize(values2, sort=True)
+    # rows with a missing value in either column are not counted
+    present = (codes1 >= 0) & (codes2 >= 0)
+    counts = np.bincount(codes2[present].astype(np.int64)*len(uniques1) + codes1[present],
+                         minlength=len(uniques1)*len(uniques2)).reshape(len(uniques2), len(uniques1))
+    rows = counts.any(axis=1)
+    columns = counts.any(axis=0)
+    counts = counts[rows][:, columns]
+    table = pd.DataFrame(counts,
+                         index=pd.Index(np.asarray(uniques2)[rows], name=values2.name),
+                         columns=pd.Index(np.asarray(uniques1)[columns], name=values1.name))
+    if (counts == 0).any():
+        table = table.where(table > 0)
+    return table
+
+def stacked_barplot(df, col1, col2, tickmode='auto', table_key=None, folder=None):
     """
     Creates a stacked bar plot with col1 as the stacked bars
     and col2 on the x-axis
@@ -52,17 +122,11 @@ def stacked_barplot(df, col1, col2, tickmode='auto'):
     col1: name of column as string
     col2: name of column as string
     tickmode: when == 'linear', show all x-axis labels
+    table_key, folder: passed to crosstab
     """
 
-    # Get dataframe of col1,col2 and frequency of people with that col1/col2
-    df = df[[col1, col2]] \
-        .groupby([col2, col1]) \
-        .agg({col1: 'size'}) \
-        .rename(columns={col1: 'count'}) \
-        .reset_index()
-
-    # pivot the table in the correct format for a stacked bar plot
-    df = df.pivot(index=col2, columns=col1)['count']
+    # frequency of people with each col1/col2, in the correct format for a stacked bar plot
+    df = crosstab(df, col1, col2, table_key, folder)
     x = df.index
 
     # create plotly plot
@@ -92,15 +156,19 @@ def stacked_barplot(df, col1, col2, tickmode='auto'):
     po.iplot(fig)
 
 
-def av_patient_frequency(av_patient, search_var, topN = 20):
+def av_patient_frequency(av_patient, search_var, topN = 20, table_key=None, folder=None):
+    """
+    Bar plot of the numbers of male and female patients with the 2nd to topN-th
+    most frequent values of search_var. table_key, folder: passed to crosstab,
+    which gives the male and female counts
+    """
+    # rank over all patients, including those with no SEX
     top = av_patient[search_var].value_counts()[1:topN].keys()
-    top = av_patient.loc[av_patient[search_var].isin(top)]
-
-    topbysex = top.groupby(['SEX', search_var]) \
-        .agg({search_var: 'size'})
+    bysex = crosstab(av_patient, search_var, 'SEX', table_key, folder)
+    topbysex = bysex.loc[:, bysex.columns.isin(top)]
 
-    male = topbysex.loc['1'][search_var]
-    female = topbysex.loc['2'][search_var]
+    male = topbysex.loc['1'].dropna().astype(int)
+    female = topbysex.loc['2'].dropna().astype(int)
 
     # plotly plots
     trace1 = go.Bar(
@@ -128,13 +196,15 @@ def av_patient_frequency(av_patient, search_var, topN = 20):
     fig = go.Figure(data=data, layout=layout)
     po.iplot(fig)
     
-def Sequenceofevents(df_full_patient_pathways,event_types,dates):
+def Sequenceofevents(df_full_patient_pathways,event_types,dates,categorical=False):
     """Creates a dataframe with the sequence of event per patient, 
     where each row would be one event. The event_types are chosen
     from the columns of df_full_patient_pathways, and there dates
-    are columns from df_full_patient_pathways also"""
+    are columns from df_full_patient_pathways also
     
-    df_pathway_events = pd.DataFrame()
+    categorical: return the 'event' and 'event_type' columns as categoricals"""
+    
+    event_frames = []
     
     for date, event_type in zip(dates,event_types):
 
@@ -142,23 +212,21 @@ def Sequenceofevents(df_full_patient_pathways,event_types,dates):
         #we must drop duplicates as some are replicated due to the merging
         #in cancerdata_EDA
         df = df_full_patient_pathways[['PATIENTID', date, event_type]].drop_duplicates()
-        df = df.rename(index=str, columns={date:'date', event_type:'event'})
 
         #any event with 'N either means 
         #NO(nothing happend) or not known(for outcome summary)'
-        df = df[df['event'] != 'N']
-
-        df['event_type'] = event_type
-
-        #get rid of NaN events
-        df = df[df['event'].notnull()]
+        #and get rid of NaN events
+        events = df[event_type]
+        df = df[(events != 'N') & events.notnull()]
 
         #some drug group values are the same as there regimen values
-        df['event'] = df['event_type'] + " " + df['event'].astype(str)
-
-        #stack the events and event dates
-        df_pathway_events = pd.concat([df_pathway_events,df])
+        event_frames.append(pd.DataFrame({'PATIENTID': df['PATIENTID'].values,
+                                          'date': df[date].values,
+                                          'event': (event_type + " " + df[event_type].astype(str)).values,
+                                          'event_type': event_type}))
 
+    #stack the events and event dates
+    df_pathway_events = pd.concat(event_frames, ignore_index=True)
     df_pathway_events = df_pathway_events.sort_values(by = ['PATIENTID','date'])
     
     #Now convert dates to number of days passed since first event. 
@@ -166,42 +234,185 @@ def Sequenceofevents(df_full_patient_pathways,event_types,dates):
     #so we should remove dates below these
     
     #remove years below 2013
-    correct_years = pd.to_datetime(df_pathway_events['date']).apply(lambda date: date.year)>2012
+    event_dates = pd.to_datetime(df_pathway_events['date'])
+    correct_years = (event_dates.dt.year > 2012).values
     df_pathway_events = df_pathway_events[correct_years]
 
     #make a column 'days' which has the number of days
-    #since the first event of a given patient
-    df_dates = df_pathway_events[['PATIENTID','date']]
-    df_dates['date'] = pd.to_datetime(df_dates['date'])
-
-    #dates of the first event of a patient
-    df_start_dates = df_dates.groupby('PATIENTID').first().reset_index().rename(columns={'date':'start date'})
-
-    #days from the first event of a patient
-    df_dates = pd.merge(df_dates,df_start_dates,how='left')
-    df_dates['days'] = df_dates['date']-df_dates['start date']
-    df_pathway_events['days'] = [d.days for d in df_dates['days']]
-
-    #remove nans
-    df_pathway_events = df_pathway_events[df_pathway_events['days'].notnull()]
+    #since the first event of a given patient, in integer nanoseconds
+    nanoseconds = event_dates.values[correct_years].astype('datetime64[ns]').astype(np.int64)
+    start_nanoseconds = pd.Series(nanoseconds).groupby(df_pathway_events['PATIENTID'].values).transform('min').values
+    df_pathway_events['days'] = (nanoseconds - start_nanoseconds) // (24*60*60*10**9)
     
     #add diagnosis of patient as a column
     df_cancers = df_full_patient_pathways[['PATIENTID','PRIMARY_DIAGNOSIS']].drop_duplicates()
     df_pathway_events = pd.merge(df_pathway_events,df_cancers,how='left',on='PATIENTID')
     
+    if categorical:
+        df_pathway_events['event'] = df_pathway_events['event'].astype('category')
+        df_pathway_events['event_type'] = df_pathway_events['event_type'].astype('category')
+    
     return df_pathway_events
 
-def plotevents(df_event_vector,event_types):
+def sample_without_replacement(rng, n, k):
+    """k distinct random integers from range(n) (all of them if k >= n), in random order.
+    When k is small compared to n this costs about O(k) rather than O(n)."""
+    if 4*k >= n:
+        return rng.permutation(n)[:k]
+    sample = np.zeros(0, dtype=np.int64)
+    while len(sample) < k:
+        draws = np.concatenate([sample, rng.randint(n, size=2*(k - len(sample)))])
+        #keep the first draw of each value, in the order drawn
+        first = np.sort(np.unique(draws, return_index=True)[1])
+        sample = draws[first]
+    return sample[:k]
+
+def stratified_sample(df_rows, by, k, seed=None, groups=None):
+    """random sample of positions of the rows of df_rows, drawn without replacement
+    separately from each group
+    df_rows: dataframe with a row per sequence (e.g. SequenceStore.rows)
+    by: the column to stratify by, e.g. 'PRIMARY_DIAGNOSIS' or 'NEWVITALSTATUS_DESC'
+    k: sample size of each group, or a dict/series of sizes by group. Groups with
+       fewer rows than this are taken whole.
+    seed: seed for the random numbers, the same seed gives the same sample
+    groups: the groups to sample, by default all of them
+    returns a dict of group: array of positions in df_rows"""
+    rng = np.random.RandomState(seed)
+    codes, uniques = pd.factorize(df_rows[by])
+    #positions sorted by group, group i is order[bounds[i]:bounds[i+1]]
+    order = np.argsort(codes, kind='mergesort')
+    bounds = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+    group_codes = dict(zip(uniques, range(len(uniques))))
+    if groups is None:
+        groups = uniques
+    samples = {}
+    for group in groups:
+        size = k[group] if isinstance(k, (dict, pd.Series)) else k
+        if group not in group_codes:
+            samples[group] = np.zeros(0, dtype=np.int64)
+            continue
+        i = group_codes[group]
+        positions = order[bounds[i]:bounds[i+1]]
+        samples[group] = positions[sample_without_replacement(rng, len(positions), size)]
+    return samples
+
+def reservoir_sample(chunks, k, seed=None, by=None):
+    """random sample of k rows, without replacement, from a stream of dataframe chunks
+    (e.g. load.iter_table or SequenceStore.iter_rows), holding no more than k rows
+    of each group (plus one chunk) in memory at a time
+    by: column to stratify by, k rows are sampled from each of its values
+    seed: seed for the random numbers, the same seed and chunks give the same sample
+    returns a dataframe of the sampled rows with their original index, or a
+    dict of group: dataframe when by is given"""
+    rng = np.random.RandomState(seed)
+    reservoirs = {}
+    seen = {}
+    for chunk in chunks:
+        if by is None:
+            parts = [(None, chunk)]
+        else:
+            parts = chunk.groupby(by, sort=False, observed=True)
+        for group, part in parts:
+            reservoir = reservoirs.get(group, part.iloc[:0])
+            n_seen = seen.get(group, 0)
+            #the first k rows of the stream fill the reservoir
+            fill = min(max(k - n_seen, 0), len(part))
+            reservoir = pd.concat([reservoir, part.iloc[:fill]])
+            rest = part.iloc[fill:]
+            if len(rest):
+                #row j of the stream replaces a random slot with probability k/(j+1)
+                stream_index = n_seen + fill + np.arange(len(rest))
+                slots = (rng.random_sample(len(rest))*(stream_index + 1)).astype(np.int64)
+                rows = np.flatnonzero(slots < k)
+                slots = slots[rows]
+                #when a slot is replaced more than once in a chunk the last row wins
+                slots, last = np.unique(slots[::-1], return_index=True)
+                take = np.arange(k)
+                take[slots] = k + rows[::-1][last]
+                reservoir = pd.concat([reservoir, rest]).iloc[take]
+            reservoirs[group] = reservoir
+            seen[group] = n_seen + len(part)
+    if by is None:
+        return reservoirs.get(None, pd.DataFrame())
+    return reservoirs
+
+# Rendering modes for the event and pathway plots:
+#   'svg': one go.Scatter trace per group (per pathway for line plots)
+#   'webgl': go.Scattergl, with each group's pathways merged into one trace
+#   'density': 2D histogram of the points of each group drawn as a heatmap
+# 'webgl' switches to 'density' when there are more than max_points points
+render_modes = ['svg', 'webgl', 'density']
+default_max_points = 200000
+default_density_bins = 200
+
+
+def render_mode(render, n_points, max_points=default_max_points):
+    """the rendering mode to use for a plot of n_points points"""
+    if render not in render_modes:
+        raise ValueError("render must be one of " + str(render_modes))
+    if render == 'webgl' and max_points is not None and n_points > max_points:
+        return 'density'
+    return render
+
+def nan_separated(coordinates, offsets, positions):
+    """coordinates of the sequences at positions, one after another with a row of
+    NaN after each sequence, so plotly draws them as separate lines in one trace
+    coordinates: array with a row per event, sequence i is coordinates[offsets[i]:offsets[i+1]]"""
+    positions = np.asarray(positions, dtype=np.int64)
+    if len(positions) == 0:
+        return np.zeros((0, coordinates.shape[1]))
+    lengths = np.diff(offsets)[positions]
+    ends = np.cumsum(lengths + 1)
+    #index into coordinates of every output row, counting up from each sequence start
+    index = np.repeat(offsets[:-1][positions] - (ends - lengths - 1), lengths + 1) + np.arange(ends[-1])
+    #the extra row after each sequence points at the appended NaN row
+    index[ends - 1] = len(coordinates)
+    return np.vstack([coordinates, np.full((1, coordinates.shape[1]), np.nan)])[index]
+
+def density_range(xs, ys):
+    """[[xmin, xmax], [ymin, ymax]] over lists of x and y arrays, so groups share bins"""
+    x = np.concatenate([np.asarray(x, dtype=float) for x in xs] + [np.zeros(0)])
+    y = np.concatenate([np.asarray(y, dtype=float) for y in ys] + [np.zeros(0)])
+    if len(x) == 0:
+        return [[0, 1], [0, 1]]
+    return [[np.nanmin(x), np.nanmax(x)], [np.nanmin(y), np.nanmax(y)]]
+
+def density_trace(x, y, name, color, bins=default_density_bins, range=None):
+    """heatmap trace of the number of points in each of bins x bins cells,
+    shaded from transparent to color on a log scale. Empty cells are left blank."""
+    counts, x_edges, y_edges = np.histogram2d(x, y, bins=bins, range=range)
+    z = np.log1p(counts.T)
+    z[counts.T == 0] = np.nan
+    return go.Heatmap(x = (x_edges[:-1] + x_edges[1:])/2,
+                      y = (y_edges[:-1] + y_edges[1:])/2,
+                      z = z,
+                      name = name,
+                      showscale = False,
+                      hoverinfo = 'name+x+y',
+                      colorscale = [[0, 'rgba({}, {}, {}, 0.2)'.format(*color)],
+                                    [1, 'rgba({}, {}, {}, 1)'.format(*color)]])
+
+def plotevents(df_event_vector,event_types,render='svg',max_points=default_max_points,bins=default_density_bins):
     """plotly plot of events colour coded by event_types
-    df_event_vector: a dataframe with columns 'event_label','x','y','event_type','event' """
+    df_event_vector: a dataframe with columns 'event_label','x','y','event_type','event'
+    render: 'svg', 'webgl' or 'density' (see render_modes)
+    max_points: with render='webgl', plot densities when there are more points than this
+    bins: number of bins along each axis for render='density' """
     data=[]
+    render = render_mode(render, len(df_event_vector), max_points)
+    Scatter = go.Scattergl if render == 'webgl' else go.Scatter
+    if render == 'density':
+        xy_range = density_range([df_event_vector['x']], [df_event_vector['y']])
     color = np.random.seed(seed=20)
     for event_type in event_types:
         color=np.random.randint(255, size=(1, 3))[0]
         x = df_event_vector[df_event_vector['event_type']==event_type]['x']
         y = df_event_vector[df_event_vector['event_type']==event_type]['y']
         events = df_event_vector[df_event_vector['event_type']==event_type]['event']
-        trace = go.Scatter( x = x,
+        if render == 'density':
+            data.append(density_trace(x, y, event_type, color, bins, xy_range))
+            continue
+        trace = Scatter( x = x,
                             y = y,
                             mode = 'markers',
                             text = events,
@@ -222,31 +433,82 @@ def plotevents(df_event_vector,event_types):
     fig = dict(data=data, layout=layout)
     po.iplot(fig)
     
-def plotpathways(df_sequences,topN,map2D):
+def plotpathways(df_sequences,topN,map2D,samples=100,render='svg',max_points=default_max_points,bins=default_density_bins,
+                 seed=None):
     """plots pathways by adding up the vectors of each event in a sequence
     df_sequences:dataframe with a 'sequence' column that has lists of events in a sequence
+                 (or a sequences.SequenceStore)
     topN: plots the topN cancers
-    map2D: maps the event label to it's vector"""
+    map2D: maps the event label to it's vector
+    samples: number of pathways plotted per cancer, None plots them all
+    seed: if given, samples are drawn without replacement with this seed (see
+          stratified_sample), otherwise with replacement from the random module
+    render: 'svg' draws a trace per pathway, 'webgl' one Scattergl trace per cancer
+            and 'density' a heatmap of the pathway points per cancer (see render_modes)
+    max_points: with render='webgl', plot densities when there are more points than this
+    bins: number of bins along each axis for render='density'"""
+    df_rows, event_sequences = sequences.rows_and_sequences(df_sequences)
+
+    #coordinates along every pathway, worked out for all sequences at once
+    pathway_coordinates, offsets = sequences.pathway_coordinates(event_sequences, map2D)
+    lengths = np.diff(offsets)
+    
     data=[]
     
-    top5cancers = df_sequences['PRIMARY_DIAGNOSIS'].value_counts().keys()[:topN]
+    top5cancers = df_rows['PRIMARY_DIAGNOSIS'].value_counts().keys()[:topN]
+
+    if seed is not None and samples is not None:
+        cancer_samples = stratified_sample(df_rows, 'PRIMARY_DIAGNOSIS', samples, seed, groups=top5cancers)
 
     np.random.seed(seed=20)
+    groups = []
     for c in top5cancers:
 
         color = np.random.randint(255, size=(1, 3))[0]
 
-        c_sequences = df_sequences[df_sequences['PRIMARY_DIAGNOSIS'] == c]
-        c_sequences100 = random.choices(list(c_sequences['sequence']),k=100)
+        if samples is None:
+            c_sequences100 = np.flatnonzero((df_rows['PRIMARY_DIAGNOSIS'] == c).values)
+        elif seed is not None:
+            c_sequences100 = cancer_samples[c]
+        else:
+            c_positions = np.flatnonzero((df_rows['PRIMARY_DIAGNOSIS'] == c).values)
+            c_sequences100 = random.choices(c_positions,k=samples)
+        groups.append((c, color, c_sequences100))
+
+    n_points = sum(lengths[np.asarray(s, dtype=np.int64)].sum() for _, _, s in groups)
+    render = render_mode(render, n_points, max_points)
+    if render == 'density':
+        group_coordinates = [nan_separated(pathway_coordinates, offsets, s) for _, _, s in groups]
+        xy_range = density_range([xy[:,0] for xy in group_coordinates],
+                                 [xy[:,1] for xy in group_coordinates])
+
+    for g, (c, color, c_sequences100) in enumerate(groups):
+
+        if render == 'density':
+            coordinates = group_coordinates[g]
+            coordinates = coordinates[~np.isnan(coordinates[:,0])]
+            data.append(density_trace(coordinates[:,0], coordinates[:,1], c, color, bins, xy_range))
+            continue
+
+        if render == 'webgl':
+            coordinates = nan_separated(pathway_coordinates, offsets, c_sequences100)
+            trace = go.Scattergl( x = coordinates[:,0],
+                                  y = coordinates[:,1],
+                                  mode = 'lines',
+                                  name = c,
+                                  legendgroup = c,
+                                  connectgaps = False,
+                                  line=dict(width=1,
+                                            color='rgb({}, {}, {})'.format(*color)))
+            data.append(trace)
+            continue
 
         legend = True
-        for s in c_sequences100:
-            event_vectors = np.array([list(map2D[e]) for e in s])
-            pathway_coordinates = np.cumsum(event_vectors, axis=0)
+        for i in c_sequences100:
+            coordinates = pathway_coordinates[offsets[i]:offsets[i+1]]
 
-
-            trace = go.Scatter( x = pathway_coordinates[:,0],
-                                y = pathway_coordinates[:,1],
+            trace = go.Scatter( x = coordinates[:,0],
+                                y = coordinates[:,1],
                                 mode = 'lines',
                                 name = c,
                                 legendgroup = c,
@@ -266,14 +528,27 @@ def plotpathways(df_sequences,topN,map2D):
     fig = dict(data=data, layout=layout)
     po.iplot(fig)
 
-def plotendpoints_alivedead(df_sequences, topN, map2D):
+def plotendpoints_alivedead(df_sequences, topN, map2D, samples=2000, render='svg',
+                            max_points=default_max_points, bins=default_density_bins, seed=None):
     """plots endpoints of pathways. First colours by alive/dead then by cancer type.
     df_sequences:dataframe with a 'sequence' column that has lists of events in a sequence
+                 (or a sequences.SequenceStore with a NEWVITALSTATUS_DESC column)
     topN: plots the topN cancers
     map2D: maps the event label to it's vector
+    samples: about how many endpoints to plot in each row, None plots them all
+    seed: if given, samples are drawn without replacement with this seed (see
+          stratified_sample), otherwise with replacement from the random module
+    render: 'svg', 'webgl' or 'density' (see render_modes)
+    max_points: with render='webgl', plot densities when there are more points than this
+    bins: number of bins along each axis for render='density'
     """
+    df_rows, event_sequences = sequences.rows_and_sequences(df_sequences)
+
+    #endpoints of every pathway, worked out for all sequences at once
+    end_coordinates = sequences.end_coordinates(event_sequences, map2D)
+    end_r, end_t = sequences.polar_coordinates(end_coordinates)
     
-    count_alive_dead = df_sequences['NEWVITALSTATUS_DESC'].value_counts()[:2]
+    count_alive_dead = df_rows['NEWVITALSTATUS_DESC'].value_counts()[:2]
     total_alive_dead = count_alive_dead.sum()
 
     fig = tools.make_subplots(rows=2, cols=2, subplot_titles=('Coloured by Alive/Dead, Cartesian',
@@ -281,90 +556,67 @@ def plotendpoints_alivedead(df_sequences, topN, map2D):
                                                               'Coloured by cancer type, Cartesian',
                                                               'Coloured by cancer type, Polar'))
 
-    np.random.seed(seed=20)
-    for c in count_alive_dead.keys():
-
-        color = np.random.randint(255, size=(1, 3))[0]
-
-        c_sequences = df_sequences[df_sequences['NEWVITALSTATUS_DESC'] == c]
-        c_sequences100 = random.choices(list(c_sequences['sequence']),k=2000*count_alive_dead[c]//total_alive_dead)
-
-        legend = True
-        end_coordinates_x = []
-        end_coordinates_y = []
-        end_coordinates_r = []
-        end_coordinates_t = []
-        for s in c_sequences100:
-            event_vectors = np.array([list(map2D[e]) for e in s])
-            end_coordinates = np.sum(event_vectors, axis=0)
-            end_coordinates_x.append(end_coordinates[0])
-            end_coordinates_y.append(end_coordinates[1])
-            end_coordinates_r.append(np.sqrt(end_coordinates[0]**2 + end_coordinates[1]**2))
-            end_coordinates_t.append(np.arctan2(end_coordinates[1], end_coordinates[0]))
-
-        trace_cartesian = go.Scatter( x = end_coordinates_x,
-                            y = end_coordinates_y,
-                            mode = 'markers',
-                            name = c,
-                            opacity = 1,
-                            marker=dict(size=1,color='rgb({}, {}, {})'.format(*color)), 
-                            showlegend = legend)
-
-        trace_polar = go.Scatter( x = end_coordinates_t,
-                            y = end_coordinates_r,
-                            mode = 'markers',
-                            name = c,
-                            opacity = 1,
-                            marker=dict(size=1,color='rgb({}, {}, {})'.format(*color)), 
-                            showlegend = legend)
-        legend = False
-
-        fig.append_trace(trace_cartesian, 1, 1)
-        fig.append_trace(trace_polar, 1, 2)
-
-    count_top_cancers = df_sequences['PRIMARY_DIAGNOSIS'].value_counts()[:topN]
-    total_top_cancers = count_alive_dead.sum()
-
-    np.random.seed(seed=20)
-    for c in count_top_cancers.keys():
+    count_top_cancers = df_rows['PRIMARY_DIAGNOSIS'].value_counts()[:topN]
+
+    for row, column, counts in [(1, 'NEWVITALSTATUS_DESC', count_alive_dead),
+                                (2, 'PRIMARY_DIAGNOSIS', count_top_cancers)]:
+        sizes = {c: samples*counts[c]//total_alive_dead for c in counts.keys()} if samples is not None else None
+        if seed is not None and samples is not None:
+            group_samples = stratified_sample(df_rows, column, sizes, seed, groups=counts.keys())
+
+        np.random.seed(seed=20)
+        groups = []
+        for c in counts.keys():
+
+            color = np.random.randint(255, size=(1, 3))[0]
+
+            if samples is None:
+                c_sequences100 = np.flatnonzero((df_rows[column] == c).values)
+            elif seed is not None:
+                c_sequences100 = group_samples[c]
+            else:
+                c_positions = np.flatnonzero((df_rows[column] == c).values)
+                c_sequences100 = random.choices(c_positions,k=sizes[c])
+            groups.append((c, color, np.asarray(c_sequences100, dtype=np.int64)))
+
+        row_render = render_mode(render, sum(len(s) for _, _, s in groups), max_points)
+        Scatter = go.Scattergl if row_render == 'webgl' else go.Scatter
+        if row_render == 'density':
+            cartesian_range = density_range([end_coordinates[s,0] for _, _, s in groups],
+                                            [end_coordinates[s,1] for _, _, s in groups])
+            polar_range = density_range([end_t[s] for _, _, s in groups],
+                                        [end_r[s] for _, _, s in groups])
+
+        for c, color, c_sequences100 in groups:
+
+            if row_render == 'density':
+                fig.append_trace(density_trace(end_coordinates[c_sequences100,0],
+                                               end_coordinates[c_sequences100,1],
+                                               c, color, bins, cartesian_range), row, 1)
+                fig.append_trace(density_trace(end_t[c_sequences100], end_r[c_sequences100],
+                                               c, color, bins, polar_range), row, 2)
+                continue
+
+            legend = True
+            trace_cartesian = Scatter( x = end_coordinates[c_sequences100,0],
+                                y = end_coordinates[c_sequences100,1],
+                                mode = 'markers',
+                                name = c,
+                                opacity = 1,
+                                marker=dict(size=1,color='rgb({}, {}, {})'.format(*color)), 
+                                showlegend = legend)
 
-        color = np.random.randint(255, size=(1, 3))[0]
+            trace_polar = Scatter( x = end_t[c_sequences100],
+                                y = end_r[c_sequences100],
+                                mode = 'markers',
+                                name = c,
+                                opacity = 1,
+                                marker=dict(size=1,color='rgb({}, {}, {})'.format(*color)), 
+                                showlegend = legend)
+            legend = False
 
-        c_sequences = df_sequences[df_sequences['PRIMARY_DIAGNOSIS'] == c]
-        c_sequences100 = random.choices(list(c_sequences['sequence']),k=2000*count_top_cancers[c]//total_top_cancers)
-
-        legend = True
-        end_coordinates_x = []
-        end_coordinates_y = []
-        end_coordinates_r = []
-        end_coordinates_t = []
-        for s in c_sequences100:
-            event_vectors = np.array([list(map2D[e]) for e in s])
-            end_coordinates = np.sum(event_vectors, axis=0)
-            end_coordinates_x.append(end_coordinates[0])
-            end_coordinates_y.append(end_coordinates[1])
-            end_coordinates_r.append(np.sqrt(end_coordinates[0]**2 + end_coordinates[1]**2))
-            end_coordinates_t.append(np.arctan2(end_coordinates[1], end_coordinates[0]))
-
-        trace_cartesian = go.Scatter( x = end_coordinates_x,
-                            y = end_coordinates_y,
-                            mode = 'markers',
-                            name = c,
-                            opacity = 1,
-                            marker=dict(size=1,color='rgb({}, {}, {})'.format(*color)), 
-                            showlegend = legend)
-
-        trace_polar = go.Scatter(x = end_coordinates_t,
-                                 y = end_coordinates_r,
-                                 mode = 'markers',
-                                 name = c,
-                                 opacity = 1,
-                                 marker=dict(size=1,color='rgb({}, {}, {})'.format(*color)), 
-                                 showlegend = legend)
-        legend = False
-
-        fig.append_trace(trace_cartesian, 2, 1)
-        fig.append_trace(trace_polar, 2, 2)
+            fig.append_trace(trace_cartesian, row, 1)
+            fig.append_trace(trace_polar, row, 2)
 
     fig['layout'].update(title='Visualising ends of patient pathways')
 
@@ -417,49 +669,65 @@ def clusterinfo(df_single_cancer,
                 display=['REGIMEN_OUTCOME_SUMMARY',
                          'BENCHMARK_GROUP',
                          'DRUG_GROUP']):
+    """table summarising each cluster: its size, the mean and standard deviation
+    of the days in its sequences and the top most frequent events of each of the
+    display event types
+    df_single_cancer: has columns 'PATIENTID', 'cluster' and 'sequence_days'
+    df_pathway_events: output of Sequenceofevents
+    single_cancer: the PRIMARY_DIAGNOSIS that was clustered. If None, df_single_cancer
+                   holds the clusters of every cancer (with a 'PRIMARY_DIAGNOSIS' column)
+                   and all of them are summarised at once
+    top: the number of events shown for each event type"""
+
+    if single_cancer is None:
+        by = ['PRIMARY_DIAGNOSIS', 'cluster']
+        df_single_cancer_seq = df_pathway_events
+    else:
+        by = ['cluster']
+        #get df_pathway_events of the single cancer
+        df_single_cancer_seq = df_pathway_events[df_pathway_events['PRIMARY_DIAGNOSIS']==single_cancer]
+    keys = ['PATIENTID'] + by[:-1]
 
-    #get df_pathway_events of the single cancer
-    df_single_cancer_seq = df_pathway_events[df_pathway_events['PRIMARY_DIAGNOSIS']==single_cancer]
-
-    #add the cluster labels into the df_single_cancer_seq
-    df_single_cancer_seq = pd.merge(df_single_cancer_seq,df_single_cancer[['PATIENTID','cluster']], how = 'left')
+    #add the cluster labels to the events of the display event types
+    df_single_cancer_seq = df_single_cancer_seq.loc[df_single_cancer_seq['event_type'].isin(display),
+                                                    keys + ['event_type', 'event']]
+    df_single_cancer_seq = pd.merge(df_single_cancer_seq, df_single_cancer[keys + ['cluster']], on=keys)
 
     #cluster freq
-    cluster_freq = df_single_cancer[['PATIENTID', 'cluster']]['cluster'].value_counts()
-    df_cluster_freq = pd.DataFrame({'cluster': cluster_freq.keys(),'cluster_freq':cluster_freq.values})    
-
-    #remove the event type in the 'event' column
-    df_single_cancer_seq['event'] = [e[len(et)+1:] for e,et in
-                                    zip(df_single_cancer_seq['event'],df_single_cancer_seq['event_type'])]
-    df_single_cancer_seq = df_single_cancer_seq[df_single_cancer_seq['event_type'].isin(display)]
-
-    #make the top event_types as columns and use the events frequencies as rows
-
-    dfc = df_single_cancer_seq.groupby(['cluster','event_type','event']).agg({'event':'count'}).rename(columns={'event':'event_%'})
-    dfc = dfc.groupby(['cluster','event_type']).apply(lambda x: round(100*x/x.sum(),1))
-    
-
-    dfc = dfc.reset_index().groupby(['cluster','event_type']).apply(lambda x: x.nlargest(top,'event_%'))
-    dfc = dfc.reset_index(drop=True)
-    dfc['event'] = dfc['event_%'].astype(str) + "% " + dfc['event']
-    dfc
-
-    dfc['top'] = dfc.groupby(['cluster','event_type']).cumcount()+1
-    dfc['event_type'] = dfc['event_type'] + " " + dfc['top'].astype(str)
-    dfc = dfc.pivot(values='event',columns='event_type',index='cluster').reset_index()
-
-
+    df_cluster_freq = df_single_cancer.groupby(by).size().rename('cluster_freq').reset_index()
+
+    #count events on categorical codes and turn the counts into percentages of each event type
+    df_single_cancer_seq['event_type'] = df_single_cancer_seq['event_type'].astype('category')
+    df_single_cancer_seq['event'] = df_single_cancer_seq['event'].astype('category')
+    event_counts = df_single_cancer_seq.groupby(by + ['event_type','event'], observed=True).size()
+    type_totals = event_counts.groupby(level=list(range(len(by) + 1))).transform('sum')
+    dfc = (100*event_counts/type_totals).round(1).rename('event_%').reset_index()
+
+    #keep the top events of each event type, ties in order of event
+    dfc = dfc.sort_values(by + ['event_type','event_%','event'],
+                          ascending=[True]*(len(by) + 1) + [False, True], kind='mergesort')
+    dfc['top'] = dfc.groupby(by + ['event_type'], observed=True).cumcount()+1
+    dfc = dfc[dfc['top'] <= top]
+
+    #remove the event type in the 'event' column and make the top event_types as columns
+    event_type = dfc['event_type'].astype(str)
+    event = [e[len(et)+1:] for e,et in zip(dfc['event'].astype(str),event_type)]
+    dfc['event'] = dfc['event_%'].astype(str) + "% " + pd.Series(event, index=dfc.index, dtype=object)
+    dfc['event_type'] = event_type + " " + dfc['top'].astype(str)
+    dfc = dfc.pivot(values='event',columns='event_type',index=by).reset_index()
 
     #get mean days in sequence with standard deviation
-    df_single_cancer['total days in sequence'] = df_single_cancer['sequence_days'].apply(lambda x: x[-1])
-    dfcmean = df_single_cancer.groupby('cluster')[['total days in sequence']].apply(lambda x: round(x.mean()).astype(int) ).reset_index().rename(columns = {'total days in sequence':'mean'})
-    dfcstd = u"\u00B1" + " " + df_single_cancer.groupby('cluster')[['total days in sequence']].apply(lambda x: round(x.std()).astype(int) ).reset_index().rename(columns = {'total days in sequence':'std'})['std'].astype(str) 
-    dfcmean['days in sequence'] = dfcmean['mean'].astype(str) + " " + dfcstd
-    
+    df_single_cancer['total days in sequence'] = df_single_cancer['sequence_days'].str[-1]
+    total_days = df_single_cancer.groupby(by)['total days in sequence']
+    dfcmean = total_days.mean().round().astype(int).rename('mean').reset_index()
+    #the std of a one-patient cluster is NaN, show it as 0
+    dfcstd = total_days.std().fillna(0).round().astype(int).reset_index(drop=True)
+    dfcmean['days in sequence'] = dfcmean['mean'].astype(str) + " " + u"\u00B1" + " " + dfcstd.astype(str)
+
     #merge all information
-    df = pd.merge(dfcmean[['cluster','days in sequence']], dfc)
-    df = pd.merge(df_cluster_freq,df,on='cluster')
-    df = df.sort_values(by=['cluster'])
+    df = pd.merge(dfcmean[by + ['days in sequence']], dfc)
+    df = pd.merge(df_cluster_freq,df,on=by)
+    df = df.sort_values(by=by)
     df = df.reset_index(drop=True)
     
     return df
@@ -0,0 +1,127 @@
+"""
+module for running SQL queries on the tables
+Version 1.1.0
+for use with simulacrum_release_v1.1.0
+"""
+
+import os
+import re
+import sqlite3
+import pandas as pd
+import load
+
+# columns that get an index in the database, where a table has them
+index_columns = [
+    'PATIENTID',
+    'TUMOURID',
+    'LINKNUMBER',
+    'LINK_NUMBER',
+    'MERGED_PATIENT_ID',
+    'MERGED_TUMOUR_ID',
+    'MERGED_REGIMEN_ID',
+    'MERGED_OUTCOME_ID',
+    'MERGED_CYCLE_ID',
+    'MERGED_DRUG_DETAIL_ID',
+    'SITE_ICD10_O2_3CHAR'
+]
+
+# open database connections, by database path
+connections = {}
+
+
+def database_path(folder=load.default_folder, prefix=load.default_prefix):
+    """
+    Path of the SQLite database that holds the tables of a folder.
+    """
+    return os.path.join(folder, prefix + "tables.sqlite")
+
+def sql_table_name(table_name, prefix=load.default_prefix):
+    """
+    Name of a table in the database, e.g. SIM_AV_TUMOUR for 'av_tumour'.
+    """
+    return (prefix + table_name).upper()
+
+def query(sql, params=None, folder=load.default_folder, prefix=load.default_prefix):
+    """
+    Runs an SQL query on the tables and returns the result as a dataframe.
+    Tables are named as in the simulacrum release, e.g.
+
+        query(\"\"\"
+        SELECT COUNT(DISTINCT PATIENTID) FROM SIM_AV_TUMOUR
+        WHERE SITE_ICD10_O2_3CHAR='C50'
+        \"\"\")
+
+    The tables are kept in an SQLite database next to the csv files (see
+    database_path), with indexes on the ID columns and SITE_ICD10_O2_3CHAR.
+    Each table is added to it, typed as by load.load_table, the first time a
+    query uses it and rebuilt when its csv changes, so later queries (also
+    in new sessions) don't copy any data.
+
+    params: values for ? placeholders in sql
+    """
+    connection = connect(folder, prefix)
+    build_database(_referenced_tables(sql, prefix), folder, prefix)
+    return pd.read_sql_query(sql, connection, params=params)
+
+def connect(folder=load.default_folder, prefix=load.default_prefix):
+    """
+    Connection to the database of a folder, opened once and reused.
+    """
+    path = database_path(folder, prefix)
+    connection = connections.get(path)
+    if connection is None:
+        connection = connections[path] = sqlite3.connect(path)
+        connection.execute("CREATE TABLE IF NOT EXISTS _tables (name TEXT PRIMARY KEY, version TEXT)")
+    return connection
+
+def close(folder=load.default_folder, prefix=load.default_prefix):
+    """
+    Closes the connection to the database of a folder.
+    """
+    connection = connections.pop(database_path(folder, prefix), None)
+    if connection is not None:
+        connection.close()
+
+def build_database(table_names=load.table_names,
+                   folder=load.default_folder,
+                   prefix=load.default_prefix,
+                   rebuild=False):
+    """
+    Adds the tables to the database, skipping those already there and up to
+    date with their csv unless rebuild=True.
+
+    Returns the list of tables that were (re)built.
+    """
+    connection = connect(folder, prefix)
+    versions = dict(connection.execute("SELECT name, version FROM _tables").fetchall())
+    built = []
+    for table_name in table_names:
+        table_name = table_name.lower()
+        read_path = load.table_path(table_name, folder, prefix)
+        if not os.path.exists(read_path):
+            raise ValueError("The file " + read_path + " does not exist.")
+        stat = os.stat(read_path)
+        version = repr((stat.st_size, stat.st_mtime_ns))
+        name = sql_table_name(table_name, prefix)
+        if not rebuild and versions.get(name) == version:
+            continue
+        _write_table(connection, name, load.load_table(table_name, folder=folder, prefix=prefix))
+        connection.execute("INSERT OR REPLACE INTO _tables VALUES (?, ?)", (name, version))
+        connection.commit()
+        built.append(table_name)
+    return built
+
+def _write_table(connection, name, table):
+    connection.execute("DROP TABLE IF EXISTS " + name)
+    table.to_sql(name, connection, index=False, chunksize=100000)
+    for column in index_columns:
+        if column in table.columns:
+            connection.execute("CREATE INDEX {0}_{1} ON {0} ({1})".format(name, column))
+
+def _referenced_tables(sql, prefix):
+    """
+    The tables whose names appear in sql.
+    """
+    sql = sql.upper()
+    return [table_name for table_name in load.table_names
+            if re.search(r"\b" + sql_table_name(table_name, prefix) + r"\b", sql)]
@@ -0,0 +1,47 @@
+"""
+tests of slap.clusterinfo
+"""
+
+import os
+import sys
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import slap
+
+
+def clusters():
+    """
+    Clusters of two cancers, where cluster 1 of C50 and cluster 0 of C61
+    have a single patient.
+    """
+    df = pd.DataFrame({'PATIENTID': [1, 2, 3, 4, 5, 6],
+                       'PRIMARY_DIAGNOSIS': ['C50', 'C50', 'C50', 'C61', 'C61', 'C61'],
+                       'cluster': [0, 0, 1, 0, 1, 1],
+                       'sequence_days': [[0, 10], [0, 20], [0, 5, 30], [0, 40], [0, 7], [0, 9]]})
+    events = pd.DataFrame({'PATIENTID': [1, 1, 2, 3, 3, 4, 5, 6],
+                           'event_type': ['DRUG_GROUP', 'BENCHMARK_GROUP', 'DRUG_GROUP', 'DRUG_GROUP',
+                                          'BENCHMARK_GROUP', 'DRUG_GROUP', 'DRUG_GROUP', 'DRUG_GROUP'],
+                           'event': ['DRUG_GROUP DOCETAXEL', 'BENCHMARK_GROUP FEC', 'DRUG_GROUP DOCETAXEL',
+                                     'DRUG_GROUP EPIRUBICIN', 'BENCHMARK_GROUP FEC', 'DRUG_GROUP DOCETAXEL',
+                                     'DRUG_GROUP CAPECITABINE', 'DRUG_GROUP DOCETAXEL']})
+    events['PRIMARY_DIAGNOSIS'] = events['PATIENTID'].map(df.set_index('PATIENTID')['PRIMARY_DIAGNOSIS'])
+    return df, events
+
+
+def test_single_patient_cluster_single_cancer():
+    df, events = clusters()
+    df_single_cancer = df[df['PRIMARY_DIAGNOSIS'] == 'C50'].drop(columns='PRIMARY_DIAGNOSIS')
+    info = slap.clusterinfo(df_single_cancer, events, 'C50')
+    assert info['cluster'].tolist() == [0, 1]
+    assert info['cluster_freq'].tolist() == [2, 1]
+    assert info['days in sequence'].tolist() == [u"15 ± 7", u"30 ± 0"]
+
+
+def test_single_patient_cluster_all_cancers():
+    df, events = clusters()
+    info = slap.clusterinfo(df, events, None)
+    assert info[['PRIMARY_DIAGNOSIS', 'cluster']].values.tolist() == [['C50', 0], ['C50', 1],
+                                                                     ['C61', 0], ['C61', 1]]
+    assert info['days in sequence'].tolist() == [u"15 ± 7", u"30 ± 0",
+                                                 u"40 ± 0", u"8 ± 1"]
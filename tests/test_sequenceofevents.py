@@ -0,0 +1,98 @@
+"""
+regression test of slap.Sequenceofevents against the implementation it
+replaced
+"""
+
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import slap
+
+event_types = ['PRIMARY_DIAGNOSIS', 'BENCHMARK_GROUP', 'DRUG_GROUP', 'REGIMEN_OUTCOME_SUMMARY']
+dates = ['DIAGNOSISDATEBEST', 'START_DATE_OF_REGIMEN', 'ADMINISTRATION_DATE', 'START_DATE_OF_REGIMEN']
+
+
+def old_sequenceofevents(df_full_patient_pathways, event_types, dates):
+    """slap.Sequenceofevents before it was vectorised"""
+    df_pathway_events = pd.DataFrame()
+    for date, event_type in zip(dates, event_types):
+        df = df_full_patient_pathways[['PATIENTID', date, event_type]].drop_duplicates()
+        df = df.rename(index=str, columns={date: 'date', event_type: 'event'})
+        df = df[df['event'] != 'N']
+        df['event_type'] = event_type
+        df = df[df['event'].notnull()]
+        df['event'] = df['event_type'] + " " + df['event'].astype(str)
+        df_pathway_events = pd.concat([df_pathway_events, df])
+    df_pathway_events = df_pathway_events.sort_values(by=['PATIENTID', 'date'])
+    correct_years = pd.to_datetime(df_pathway_events['date']).apply(lambda date: date.year) > 2012
+    df_pathway_events = df_pathway_events[correct_years]
+    df_dates = df_pathway_events[['PATIENTID', 'date']]
+    df_dates['date'] = pd.to_datetime(df_dates['date'])
+    df_start_dates = df_dates.groupby('PATIENTID').first().reset_index().rename(columns={'date': 'start date'})
+    df_dates = pd.merge(df_dates, df_start_dates, how='left')
+    df_dates['days'] = df_dates['date'] - df_dates['start date']
+    df_pathway_events['days'] = [d.days for d in df_dates['days']]
+    df_pathway_events = df_pathway_events[df_pathway_events['days'].notnull()]
+    df_cancers = df_full_patient_pathways[['PATIENTID', 'PRIMARY_DIAGNOSIS']].drop_duplicates()
+    df_pathway_events = pd.merge(df_pathway_events, df_cancers, how='left', on='PATIENTID')
+    return df_pathway_events
+
+
+def pathways(n_patients=300, seed=0):
+    """
+    Synthetic merged pathways like those of cancerdata_EDA, with missing and
+    'N' events, pre-2013 and missing dates, duplicated rows, events of
+    different types on the same date and a few patients with two diagnoses.
+    """
+    rng = np.random.RandomState(seed)
+    patient_ids = np.repeat(np.arange(1, n_patients + 1), rng.randint(1, 20, n_patients))
+    n = len(patient_ids)
+
+    def random_dates():
+        values = (pd.Timestamp('2012-10-01') + pd.to_timedelta(rng.randint(0, 200, n), 'D'))
+        values = values.strftime('%Y-%m-%d').values.astype(object)
+        values[rng.random_sample(n) < 0.05] = np.nan
+        return values
+
+    def random_events(choices):
+        return rng.choice(np.array(choices + [None], dtype=object), n)
+
+    diagnoses = rng.choice(['C50', 'C61', 'C34', 'C18'], n_patients)
+    df = pd.DataFrame({'PATIENTID': patient_ids,
+                       'DIAGNOSISDATEBEST': random_dates(),
+                       'START_DATE_OF_REGIMEN': random_dates(),
+                       'ADMINISTRATION_DATE': random_dates(),
+                       'BENCHMARK_GROUP': random_events(['FEC', 'CAPECITABINE', 'DOCETAXEL', 'N']),
+                       'DRUG_GROUP': random_events(['CAPECITABINE', 'DOCETAXEL', 'EPIRUBICIN']),
+                       'REGIMEN_OUTCOME_SUMMARY': random_events(['1', '2', '3', 'N'])})
+    df['PRIMARY_DIAGNOSIS'] = diagnoses[patient_ids - 1]
+    second = df[df['PATIENTID'] % 37 == 0].assign(PRIMARY_DIAGNOSIS='C80')
+    df = pd.concat([df, second, df.iloc[:20]], ignore_index=True)
+    df['BENCHMARK_GROUP'] = df['BENCHMARK_GROUP'].astype('category')
+    return df
+
+
+def test_pathways_have_ties():
+    events = slap.Sequenceofevents(pathways(), event_types, dates)
+    assert events.duplicated(['PATIENTID', 'date']).any()
+    assert events['event_type'].nunique() == len(event_types)
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_same_as_old(seed):
+    df = pathways(seed=seed)
+    expected = old_sequenceofevents(df, event_types, dates)
+    pd.testing.assert_frame_equal(slap.Sequenceofevents(df, event_types, dates), expected)
+    pd.testing.assert_frame_equal(slap.Sequenceofevents(df, event_types, dates, categorical=False), expected)
+
+
+def test_categorical():
+    df = pathways()
+    expected = old_sequenceofevents(df, event_types, dates)
+    expected['event'] = expected['event'].astype('category')
+    expected['event_type'] = expected['event_type'].astype('category')
+    pd.testing.assert_frame_equal(slap.Sequenceofevents(df, event_types, dates, categorical=True), expected)